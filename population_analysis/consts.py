@@ -6,6 +6,25 @@ PRE_TRIAL_MS = 200
 POST_TRIAL_MS = TOTAL_TRIAL_MS - PRE_TRIAL_MS
 SPIKE_BIN_MS = 20
 PROBE_IDX = int(PRE_TRIAL_MS / SPIKE_BIN_MS)  # we want to know how many idxs into the bins the probe is (default 10)
+PYRAMID_BIN_SIZES_MS = [5, 10, 20, 50]  # Bin sizes of the firing rate pyramid, all derived from one pass of spike counts
+
+# Storage precision consts
+# dtypes the pipeline's products are saved as, 'compact' halves the size of the firing rates and spike counts
+# means and stds are still accumulated in float64, only the stored arrays use these
+PRECISIONS = {
+    "double": {"counts": "int32", "rates": "float64"},
+    "compact": {"counts": "uint16", "rates": "float32"}
+}
+DEFAULT_PRECISION = "double"
+
+# Normalizer consts
+NORMALIZER_UNIT_CHUNK_SIZE = 64  # Number of units to normalize at a time, peak memory is a block of units' firing rates
+
+# NWB layout consts
+# Compressed (units, trials, t) products are chunked one unit and a block of trials at a time, so reading a few units or
+# a block of trials only decompresses those chunks. Compression is None (contiguous), 'lzf' (fast) or 'gzip' (smaller)
+NWB_COMPRESSIONS = [None, "lzf", "gzip"]
+NWB_TRIAL_CHUNK_SIZE = 64  # Number of trials in a chunk, smallest and fastest for trial blocks in benchmark_nwb_layouts.py
 
 # Baseline consts
 NUM_FIRINGRATE_SAMPLES = int(TOTAL_TRIAL_MS / SPIKE_BIN_MS)  # Should be 35
@@ -14,6 +33,11 @@ BASELINE_IDXS = [0, 10]  # Baseline is 0:10
 
 # Mixed threshold
 MIXED_THRESHOLD = .2  # any saccade/probe within 200ms of another probe/saccade will be counted as mixed
+DEMIX_COLLISION_WINDOW = .51  # any saccade within 510ms of a probe makes it a mixed trial (SaccadicModulationTrialProcessor)
+SACCADE_PROBE_LATENCY_IDXS = 10  # 200ms is the minimum distance between a saccade and probe that can be used as a sacc
+PROBE_SACCADE_LATENCY_IDXS = 20  # 400ms min dist backwards from sacc
+RP_PERI_ALIGNMENTS = ["bin", "ms"]  # Align the RpPeri saccade template to the nearest bin, or to the ms from the spikes
+DEFAULT_RP_PERI_ALIGNMENT = "bin"
 
 # Unit filtering consts
 # TRIAL_THRESHOLD_SUM = 2.5  # NOT USED CURRENTLY Sum of all firing rates in all trials for a unit
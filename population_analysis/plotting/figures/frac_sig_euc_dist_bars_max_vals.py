@@ -9,12 +9,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy
 
+from population_analysis.consts import PRE_TRIAL_MS
 from population_analysis.quantification import QuanDistribution
 from population_analysis.quantification.euclidian import EuclidianQuantification
 from population_analysis.sessions.saccadic_modulation import NWBSession
 
 WINDOW_START = 22
 WINDOW_END = 36
+RPEXTRA_BIN_MS = 10  # Josh's responses are (t=70) at 10ms, so use the 10ms level of the firing rate pyramid
 
 
 def get_rpextra_from_nwb(nwb_filename, cluster_ids):
@@ -24,20 +26,14 @@ def get_rpextra_from_nwb(nwb_filename, cluster_ids):
     for clust in cluster_ids:
         unit_idxs.append(np.where(cluster_map == clust)[0][0])
     unit_idxs = np.array(unit_idxs)
-    rpextra = sess.units()[unit_idxs][:, sess.trial_filter_rp_extra().idxs()]
+    # (units, trials, 70) binned at 10ms from the spikes instead of upsampling the 20ms (t=35) units()
+    rpextra = sess.trial_firing_rates(RPEXTRA_BIN_MS, unit_idxs, sess.trial_filter_rp_extra().idxs())
+    # Subtract each trial's pre-probe baseline like the normalized units, the scaling factor takes care of the scale
+    baseline_len = PRE_TRIAL_MS // RPEXTRA_BIN_MS
+    rpextra -= np.mean(rpextra[:, :, :baseline_len], axis=2)[:, :, None]
     return rpextra
 
 
-def upsample_rpextra_distrib(rpextra_distrib):
-    # rpextra_distrib is going to be (10000, 35) we want (10000, 70)
-    new_rpextra = []
-    for rpe in rpextra_distrib:
-        interp = np.interp(np.arange(0, 70), np.arange(0, 35)*2, rpe)
-        new_rpextra.append(interp)
-    new_rpextra = np.array(new_rpextra)
-    return new_rpextra
-
-
 def calculate_scaling_factor(josh_rp_extra, spenc_rp_extra):
     # Take in the two arrays and get out (units,) arr for values for each unit
     # both are (units, 1, t) trial avgd resps
@@ -81,14 +77,13 @@ def get_rpe_quantification_distribution(data_dict, base_prop, cache_filename):
         raise ValueError("Cannot split proportion > 1 or < 0!")
     josh_rp_extra = data_dict["rp_extra"]  # (units, 1, t)
     rp_extra_units = get_rpextra_from_nwb(data_dict["nwb"], data_dict["clusters"])
-    upsampled_rpextra = upsample_rpextra_distrib(np.mean(rp_extra_units, axis=1))[:, None, :]
-    scaling_factor = calculate_scaling_factor(josh_rp_extra, upsampled_rpextra)
+    scaling_factor = calculate_scaling_factor(josh_rp_extra, np.mean(rp_extra_units, axis=1)[:, None, :])
 
     # Approximate across datasets with a scale factor to get it on the same log scale
     rp_extra_units *= scaling_factor[:, None, None]
 
     # Debug plot upscaled vs josh's
-    # plt.plot(np.mean(upsample_rpextra_distrib(np.mean(rp_extra_units, axis=1)), axis=0))
+    # plt.plot(np.mean(np.mean(rp_extra_units, axis=1), axis=0))
     # plt.plot(np.mean(np.mean(josh_rp_extra, axis=1), axis=0))
     # plt.show()
     proportion = int(rp_extra_units.shape[1] * base_prop)
@@ -103,8 +98,6 @@ def get_rpe_quantification_distribution(data_dict, base_prop, cache_filename):
         quan
     ).calculate()
 
-    quan_dist = upsample_rpextra_distrib(quan_dist)
-
     with open(cache_filename, "wb") as f:
         pickle.dump(quan_dist, f)
     return quan_dist  # Will return (10k, t)
@@ -17,7 +17,7 @@ def plot_2neuron_trajectory(sess, ufilt):
         axs = main_axs[:, idx]
         for motdir, ax in zip([-1, 1], axs):
             trial_filt = sess.trial_motion_filter(motdir).append(resp_trial_filter)
-            units = np.mean(sess.units()[ufilt.idxs()][:, trial_filt.idxs()], axis=1)
+            units = np.mean(sess.units(ufilt.idxs(), trial_filt.idxs()), axis=1)
             u1 = units[0]
             u2 = units[1]
 
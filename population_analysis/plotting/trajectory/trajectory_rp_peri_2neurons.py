@@ -26,11 +26,11 @@ def plot_rp_peri_2neuron_trajectory(sess: NWBSession, ufilt):
             sess.trial_motion_filter(motdir)
         )
 
-        regular_units = np.mean(sess.units()[ufilt.idxs()][:, neuron_trial_filter.idxs()], axis=1)
+        regular_units = np.mean(sess.units(ufilt.idxs(), neuron_trial_filter.idxs()), axis=1)
         plot_trajectory_arrows(regular_units[0], regular_units[1], axs[idx, 0])
         axs[idx, 0].legend()
 
-        rp_peri_units = np.mean(sess.rp_peri_units()[ufilt.idxs()][:, rp_peri_trial_filter.idxs()], axis=1)
+        rp_peri_units = np.mean(sess.rp_peri_units(ufilt.idxs(), rp_peri_trial_filter.idxs()), axis=1)
         plot_trajectory_arrows(rp_peri_units[0], rp_peri_units[1], axs[idx, 1])
         axs[idx, 1].legend()
 
@@ -30,10 +30,10 @@ def plot_rp_peri_2neuron_samefig_trajectory(sess: NWBSession, ufilt):
             sess.trial_motion_filter(motdir)
         )
 
-        regular_units = np.mean(sess.units()[ufilt.idxs()][:, neuron_trial_filter.idxs()], axis=1)
+        regular_units = np.mean(sess.units(ufilt.idxs(), neuron_trial_filter.idxs()), axis=1)
         plot_trajectory(regular_units[0], regular_units[1], axs[idx], "RpExtra", "blue", "green", "red", "RpExtraStart", "RpExtraEnd", pts=False)
 
-        rp_peri_units = np.mean(sess.rp_peri_units()[ufilt.idxs()][:, rp_peri_trial_filter.idxs()], axis=1)
+        rp_peri_units = np.mean(sess.rp_peri_units(ufilt.idxs(), rp_peri_trial_filter.idxs()), axis=1)
         plot_trajectory(rp_peri_units[0], rp_peri_units[1], axs[idx], "RpPeri", "orange", "purple", "yellow", "RpPeriStart", "RpPeriEnd", pts=False)
 
         plot_trajectory(rp_peri_units[0], rp_peri_units[1], axs[idx], "", "orange", "purple", "yellow", "RpPeriStart", "RpPeriEnd", traj=False)
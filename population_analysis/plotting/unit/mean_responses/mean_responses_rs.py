@@ -6,7 +6,7 @@ from population_analysis.sessions.saccadic_modulation import NWBSession
 
 
 def plot_rs_mean_responses(sess, unit_filter, ax_list=None):
-    units = sess.units()[unit_filter.idxs()]
+    units = sess.units(unit_idxs=unit_filter.idxs())
     neg_motfilt = sess.trial_motion_filter(-1).append(BasicFilter(sess.saccade_trial_idxs, sess.num_trials))
     pos_motfilt = sess.trial_motion_filter(1).append(BasicFilter(sess.saccade_trial_idxs, sess.num_trials))
 
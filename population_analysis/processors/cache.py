@@ -0,0 +1,142 @@
+import hashlib
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+class CacheEntry(object):
+    # Location of one stage's precalculated files, either a directory in a PrecalculationCache or the
+    # current working directory when no cache is used (entry_dir is None). key is the hash of the stage's inputs and
+    # params the entry is stored under, in the current working directory it is added to the filenames
+    FILENAME_KEY_LEN = 12  # Characters of the key added to filenames in the current working directory
+
+    def __init__(self, cache, entry_dir, key):
+        self.cache = cache
+        self.entry_dir = entry_dir
+        self.key = key
+
+    def path(self, filename):
+        if self.entry_dir is None:
+            # Without a cache dir every stage and session shares the directory, so files of different inputs or
+            # params can't collide
+            name, ext = os.path.splitext(filename)
+            return f"{name}-{self.key[:CacheEntry.FILENAME_KEY_LEN]}{ext}"
+        return os.path.join(self.entry_dir, filename)
+
+    def exists(self, *filenames):
+        # True if all the files were fully written, touches the entry so it counts as recently used
+        if self.cache is not None and not self.cache.is_complete(self.entry_dir):
+            return False
+        return all(os.path.exists(self.path(fn)) for fn in filenames)
+
+    def complete(self):
+        # Call once all of the entry's files are written
+        if self.cache is not None:
+            self.cache.mark_complete(self.entry_dir)
+
+
+class PrecalculationCache(object):
+    # Directory of precalculated stage outputs, each stage's files live in their own entry directory named by a hash
+    # of the stage's inputs and parameters, so changed inputs or parameters can never load a stale result.
+    # Least recently used entries are deleted once the cache is over max_bytes
+    COMPLETE_FILENAME = ".complete"  # Written into an entry once all of its files are saved
+    HASH_CHUNK_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self._pinned = set()  # Entries used by this process, which are never evicted since they may be memmapped
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def entry_for(cache, stage_name, inputs, params=None) -> CacheEntry:
+        # Get the CacheEntry for a stage, inputs is a func returning the list of inputs to hash
+        # without a cache the entry is in the current working directory, keyed the same way
+        if cache is None:
+            return CacheEntry(None, None, PrecalculationCache.hash_inputs(stage_name, inputs(), params))
+        return cache.entry(stage_name, inputs(), params)
+
+    @staticmethod
+    def hash_value(hasher, value):
+        # Feed a value into the hasher, arrays (including memmaps and h5py datasets) are read in chunks
+        if hasattr(value, "cache_arrays"):
+            hasher.update(type(value).__name__.encode())
+            PrecalculationCache.hash_value(hasher, value.cache_arrays())
+        elif isinstance(value, dict):
+            hasher.update(b"dict")
+            for k in sorted(value.keys()):
+                PrecalculationCache.hash_value(hasher, k)
+                PrecalculationCache.hash_value(hasher, value[k])
+        elif isinstance(value, (list, tuple)):
+            hasher.update(f"list{len(value)}".encode())
+            for v in value:
+                PrecalculationCache.hash_value(hasher, v)
+        elif hasattr(value, "shape") and hasattr(value, "dtype") and len(value.shape) > 0:
+            hasher.update(f"array{value.dtype.str}{value.shape}".encode())
+            row_bytes = max(1, int(np.prod(value.shape[1:])) * value.dtype.itemsize)
+            rows_per_chunk = max(1, PrecalculationCache.HASH_CHUNK_BYTES // row_bytes)
+            for start in range(0, value.shape[0], rows_per_chunk):
+                hasher.update(np.ascontiguousarray(value[start:start + rows_per_chunk]).tobytes())
+        else:
+            hasher.update(repr(value).encode())
+
+    @staticmethod
+    def hash_inputs(stage_name, inputs, params=None):
+        hasher = hashlib.blake2b(digest_size=16)
+        PrecalculationCache.hash_value(hasher, stage_name)
+        PrecalculationCache.hash_value(hasher, inputs)
+        PrecalculationCache.hash_value(hasher, params or {})
+        return hasher.hexdigest()
+
+    def entry(self, stage_name, inputs, params=None) -> CacheEntry:
+        key = PrecalculationCache.hash_inputs(stage_name, inputs, params)
+        entry_dir = os.path.join(self.cache_dir, f"{stage_name}-{key}")
+        os.makedirs(entry_dir, exist_ok=True)
+        self._pinned.add(entry_dir)
+        return CacheEntry(self, entry_dir, key)
+
+    def is_complete(self, entry_dir):
+        marker = os.path.join(entry_dir, PrecalculationCache.COMPLETE_FILENAME)
+        if not os.path.exists(marker):
+            return False
+        os.utime(marker)  # Mark as recently used
+        return True
+
+    def mark_complete(self, entry_dir):
+        with open(os.path.join(entry_dir, PrecalculationCache.COMPLETE_FILENAME), "w") as f:
+            f.write(str(time.time()))
+        self.evict()
+
+    def _entry_size(self, entry_dir):
+        total = 0
+        for root, _, files in os.walk(entry_dir):
+            for fn in files:
+                total += os.path.getsize(os.path.join(root, fn))
+        return total
+
+    def _last_used(self, entry_dir):
+        marker = os.path.join(entry_dir, PrecalculationCache.COMPLETE_FILENAME)
+        if os.path.exists(marker):
+            return os.path.getmtime(marker)
+        return os.path.getmtime(entry_dir)
+
+    def evict(self):
+        # Delete least recently used entries until the cache fits in max_bytes
+        if self.max_bytes is None:
+            return
+
+        entries = [os.path.join(self.cache_dir, d) for d in os.listdir(self.cache_dir)]
+        entries = [e for e in entries if os.path.isdir(e)]
+        sizes = {e: self._entry_size(e) for e in entries}
+        total = sum(sizes.values())
+
+        for entry_dir in sorted(entries, key=self._last_used):
+            if total <= self.max_bytes:
+                break
+            if entry_dir in self._pinned:
+                continue
+            print(f"Cache is over {self.max_bytes} bytes, evicting '{os.path.basename(entry_dir)}'..")
+            shutil.rmtree(entry_dir)
+            total -= sizes[entry_dir]
@@ -1,15 +1,21 @@
-import os
+import itertools
 
 import numpy as np
 
+from population_analysis.consts import DEMIX_COLLISION_WINDOW, SACCADE_PROBE_LATENCY_IDXS, PROBE_SACCADE_LATENCY_IDXS, \
+    PROBE_IDX, NUM_FIRINGRATE_SAMPLES
+from population_analysis.processors.cache import PrecalculationCache
+from population_analysis.processors.experiments.saccadic_modulation.events import EventIndex
 from population_analysis.processors.experiments.saccadic_modulation.trials import ModulationTrial, ModulationTrialGroup
-import pickle
+from population_analysis.processors.kilosort.parallel import spike_bin_idxs
 
 
 class SaccadicModulationTrialProcessor(object):
-    CACHE_FILENAME = "saccadic-trials.pickle"
+    CACHE_FILENAME = "saccadic-trials.npz"
 
-    def __init__(self, firing_rate_bins, events_data):
+    def __init__(self, firing_rate_bins, events_data, cache: PrecalculationCache = None, collision_window=DEMIX_COLLISION_WINDOW, drop_multiple_collisions=False,
+                 sac_probe_latency=SACCADE_PROBE_LATENCY_IDXS, probe_sac_latency=PROBE_SACCADE_LATENCY_IDXS,
+                 pre_idxs=PROBE_IDX, post_idxs=NUM_FIRINGRATE_SAMPLES - PROBE_IDX):
         # events_data should look like this
         # {
         #         "saccade_timestamps": saccade_timestamps,
@@ -35,70 +41,121 @@ class SaccadicModulationTrialProcessor(object):
         self.probe_blocks = events_data["probe_blocks"]
         assert self.probe_timings.shape[0] == self.probe_motions.shape[0] == self.probe_blocks.shape[0]
 
-    def _process_timings(self, timings, motions, blocks, label) -> list[ModulationTrial]:
+        self.events_data = events_data
+        self.cache = cache  # Where to store the precalculated trials, None for the current directory
+        self.collision_window = collision_window  # Max seconds between a probe and saccade for a mixed trial
+        self.drop_multiple_collisions = drop_multiple_collisions  # Exclude probes with more than one saccade in the window
+        self.sac_probe_latency = sac_probe_latency  # Min idxs from a saccade forward to a probe for the saccade to be used
+        self.probe_sac_latency = probe_sac_latency  # Min idxs from a probe forward to a saccade
+        self.pre_idxs = pre_idxs  # Trial window is [event_idx - pre_idxs, event_idx + post_idxs) in firing rate bins
+        self.post_idxs = post_idxs
+        self._event_bins = None  # {label: (bin_idxs, in_range)} of the saccades and probes, shared by every trial param set
+        self._event_index = None  # EventIndex of the saccades and probes, shared by every trial param set
+
+    def _trial_params(self, **overrides):
+        # Parameters of a trial group, the processor's settings with any overrides
+        params = {
+            "pre_idxs": self.pre_idxs,
+            "post_idxs": self.post_idxs,
+            "collision_window": self.collision_window,
+            "drop_multiple_collisions": self.drop_multiple_collisions,
+            "sac_probe_latency": self.sac_probe_latency,
+            "probe_sac_latency": self.probe_sac_latency
+        }
+        params.update(overrides)
+        return params
+
+    def event_index(self) -> EventIndex:
+        # Index of all of the session's probe and saccade timestamps ('probe', 'saccade') and firing rate bin idxs
+        # ('probe_bin', 'saccade_bin') and the grating windows. Sorted once and shared by every trial param set
+        if self._event_index is None:
+            event_bins = self._shared_event_bins()
+            self._event_index = EventIndex({
+                "probe": self.probe_timings,
+                "saccade": self.saccade_timings,
+                "probe_bin": event_bins["probe"][0],
+                "saccade_bin": event_bins["saccade"][0]
+            }, self.block_windows)
+        return self._event_index
+
+    def _event_bin_idxs(self, timings):
+        # Index of the firing rate bin each event falls into, all at once with the same edges as np.histogram
+        # returns (bin_idxs, in_range) where in_range is False for events outside of the recording
+        return spike_bin_idxs(self.firing_rate_bins, np.asarray(timings))
+
+    def _shared_event_bins(self):
+        # Firing rate bins of the saccades and probes, found once and shared by every set of trial params
+        if self._event_bins is None:
+            self._event_bins = {
+                "saccade": self._event_bin_idxs(self.saccade_timings),
+                "probe": self._event_bin_idxs(self.probe_timings)
+            }
+        return self._event_bins
+
+    def _process_timings(self, timings, motions, blocks, label, pre_idxs=PROBE_IDX, post_idxs=NUM_FIRINGRATE_SAMPLES - PROBE_IDX, event_bins=None):
+        # Default window is (-200ms, 500ms) with 20ms bins, event_bins is the (bin_idxs, in_range) of the timings if known
+        # returns (trials, event_idxs) where event_idxs is the (ascending) idx into timings of each trial
+        bin_idxs, in_range = self._event_bin_idxs(timings) if event_bins is None else event_bins
+        start_idxs = bin_idxs - pre_idxs  # -10idxs = 20ms * -10idxs = -200ms
+        end_idxs = bin_idxs + post_idxs  # 25idx * 20ms = +500ms
+
+        # Exclude events outside of the recording, or too close to its ends to have a full trial window
+        num_bins = len(self.firing_rate_bins) - 1
+        passing = np.logical_and(in_range, np.logical_and(start_idxs >= 0, end_idxs <= num_bins))
+        if not np.all(passing):
+            print(f"Found {np.sum(~passing)} {label} timestamps without enough recording around them, excluding..")
+
+        event_idxs = np.where(passing)[0]
         trs = []
-        for idx, timing in enumerate(timings):
-            mot = motions[idx]
-            block = blocks[idx]
-
-            hist, _ = np.histogram(timing, bins=self.firing_rate_bins)
-            where_my_val = np.where(hist)[0]
-            if not bool(where_my_val):
-                raise ValueError("Not enough recording! TODO fix?")
-            else:
-                firing_rate_idx = where_my_val[0]  # Index of this event in firing rate idxs
-            # TODO? Assuming bins are 20ms and window is (-200ms, 500ms)
-            start_idx = firing_rate_idx - 10  # -10idxs = 20ms * -10idxs = -200ms
-            end_idx = firing_rate_idx + 25  # 25idx * 20ms = +500ms
-            event_idx = firing_rate_idx
-            trs.append(ModulationTrial(start_idx, end_idx, event_idx, timing, label, mot, block, {}))
-        return trs
-
-    def _demix_trials(self, probe_trials, saccade_trials, add_saccades=False):
+        for idx in event_idxs:
+            trs.append(ModulationTrial(start_idxs[idx], end_idxs[idx], bin_idxs[idx], timings[idx], label, motions[idx], blocks[idx], {}))
+        return trs, event_idxs
+
+    def _demix_trials(self, probe_trials, saccade_trials, probe_event_idxs, saccade_event_idxs, add_saccades=False, collision_window=None, drop_multiple_collisions=None):
+        # A probe with a saccade within the collision window becomes a 'mixed' trial, paired with the first such saccade
+        # *_event_idxs are the idx of each trial's event in the processor's timings, see _process_timings
+        # collision_window and drop_multiple_collisions default to the processor's settings
+        collision_window = self.collision_window if collision_window is None else collision_window
+        drop_multiple_collisions = self.drop_multiple_collisions if drop_multiple_collisions is None else drop_multiple_collisions
         demixed_trials = []
 
-        found_sac = {i: False for i in range(len(saccade_trials))}  # {saccade_trial_idx: True/False} if saccade has been used in mixed
-        num_duplicates = 0
+        saccade_idxs, num_collisions = self.event_index().collisions("probe", "saccade", collision_window, probe_event_idxs, saccade_event_idxs)
+        if drop_multiple_collisions:
+            duplicates = num_collisions > 1
+        else:
+            duplicates = np.zeros((len(probe_trials),), dtype=bool)  # Every colliding probe pairs with its first saccade
+        num_duplicates = int(np.sum(duplicates))
+        if num_duplicates > 0:
+            print(f"Excluding {num_duplicates} probe trials with multiple saccades within {collision_window}s..")
+
+        for probe_idx, probe_tr in enumerate(probe_trials):
+            if duplicates[probe_idx]:
+                continue  # Don't add multiple trial ones
+            sac_idx = saccade_idxs[probe_idx]
+            if sac_idx == -1:
+                demixed_trials.append(probe_tr)  # Only probe, no matches
+                continue
 
-        for probe_tr in probe_trials:
+            sac_tr = saccade_trials[sac_idx]
             probe_start = probe_tr.start_idx
             probe_end = probe_tr.end_idx
-            num_collisions = 0
-            mixed_tr = None
-
-            for sac_idx, sac_tr in enumerate(saccade_trials):
-                sac_ev = sac_tr.event_idx
-
-                # if abs(sac_ev - probe_tr.event_idx) <= 30: # indexes by bin so x*20ms
-                if abs(sac_tr.event_time - probe_tr.event_time) <= .51:
-                    num_collisions = num_collisions + 1
-                    found_sac[sac_idx] = True
-                    mixed_tr = ModulationTrial(
-                        probe_start, probe_end, probe_tr.event_idx, probe_tr.event_time, "mixed", probe_tr.motion_direction, probe_tr.block_idx,{
-                            "probe_start": probe_start,
-                            "probe_event": probe_tr.event_idx,
-                            "probe_end": probe_end,
-                            "probe_time": probe_tr.event_time,
-                            "saccade_start": sac_tr.start_idx,
-                            "saccade_event": sac_tr.event_idx,
-                            "saccade_end": sac_tr.end_idx,
-                            "saccade_time": sac_tr.event_time
-                        })
-                    if num_collisions >= 1:
-                        break
-
-            # end sac trials loop
-            if num_collisions == 1:
-                demixed_trials.append(mixed_tr)  # Only add if we have one collision
-            elif num_collisions == 0:
-                demixed_trials.append(probe_tr)  # Only probe, no matches
-            else:
-                num_duplicates = num_duplicates + 1  # Don't add multiple trial ones
+            demixed_trials.append(ModulationTrial(
+                probe_start, probe_end, probe_tr.event_idx, probe_tr.event_time, "mixed", probe_tr.motion_direction, probe_tr.block_idx, {
+                    "probe_start": probe_start,
+                    "probe_event": probe_tr.event_idx,
+                    "probe_end": probe_end,
+                    "probe_time": probe_tr.event_time,
+                    "saccade_start": sac_tr.start_idx,
+                    "saccade_event": sac_tr.event_idx,
+                    "saccade_end": sac_tr.end_idx,
+                    "saccade_time": sac_tr.event_time
+                }))
 
         if add_saccades:
-            for idx, sac_was_found in found_sac.items():
-                if not sac_was_found:  # If there were no collisions with this saccade, mark it as Rs
-                    demixed_trials.append(saccade_trials[idx])
+            found_sac = np.zeros((len(saccade_trials),), dtype=bool)  # If saccade has been used in mixed
+            found_sac[saccade_idxs[np.logical_and(saccade_idxs != -1, ~duplicates)]] = True
+            for idx in np.where(~found_sac)[0]:  # If there were no collisions with this saccade, mark it as Rs
+                demixed_trials.append(saccade_trials[idx])
 
         return demixed_trials
 
@@ -106,52 +163,66 @@ class SaccadicModulationTrialProcessor(object):
         sort = list(sorted(trs, key=lambda x: x.event_time))
         return sort
 
-    def _filter_saccades_by_time(self, saccade_trials: list[ModulationTrial], probe_trials: list[ModulationTrial]):
-        sac_probe_latency = 10  # 200ms is the minimum distance between a saccade and probe that can be used as a sacc
-        probe_sac_latency = 20  # 400ms min dist backwards from sacc
-        # Filter out any saccades that are not within the latencies
-
-        passing_trials = []
-        for saccade_trial in saccade_trials:
-            sac_passes = True
-
-            for probe_trial in probe_trials:
-                diff = saccade_trial.event_idx - probe_trial.event_idx
-                if diff < 0: # Saccade is before probe
-                    if abs(diff) < sac_probe_latency:  # Saccade is too close to the probe to be included
-                        sac_passes = False
-                        break
-                else:
-                    if diff < probe_sac_latency:  # Saccade is after probe
-                        sac_passes = False
-                        break
-
-            if sac_passes:
-                passing_trials.append(saccade_trial)  # Didn't find any probes within the specified range, can add
-
-        return passing_trials
+    def _filter_saccades_by_time(self, saccade_trials: list[ModulationTrial], saccade_event_idxs, probe_event_idxs, sac_probe_latency=None, probe_sac_latency=None):
+        # Filter out any saccades that are not within the latencies of the probes, which default to the processor's
+        # settings. *_event_idxs are the idx of each trial's event in the processor's timings, see _process_timings
+        # The latencies can also be arrays (broadcast together) to evaluate several settings at once, then a list of the
+        # passing saccade trials of each setting is returned
+        sac_probe_latency = self.sac_probe_latency if sac_probe_latency is None else sac_probe_latency
+        probe_sac_latency = self.probe_sac_latency if probe_sac_latency is None else probe_sac_latency
+        multiple = np.ndim(sac_probe_latency) > 0 or np.ndim(probe_sac_latency) > 0
+        sac_probe_latency, probe_sac_latency = np.broadcast_arrays(sac_probe_latency, probe_sac_latency)
+        passing = self.event_index().passing_latencies("saccade_bin", "probe_bin", sac_probe_latency.ravel(), probe_sac_latency.ravel(), saccade_event_idxs, probe_event_idxs)
+
+        # Didn't find any probes within the specified range, can add
+        filtered = [[saccade_trials[idx] for idx in np.where(setting_passing)[0]] for setting_passing in passing]  # (settings,)
+        return filtered if multiple else filtered[0]
 
     def calculate(self):
-        if os.path.exists(SaccadicModulationTrialProcessor.CACHE_FILENAME):
+        return self._calculate_group(self._trial_params())
+
+    def sweep(self, pre_idxs=None, post_idxs=None, collision_windows=None, latencies=None):
+        # Trial groups for every combination of the given settings, each is a list and defaults to the processor's
+        # setting, latencies is a list of (sac_probe_latency, probe_sac_latency). Events are only binned and sorted once
+        # (see event_index) and each group is cached separately, so settings can be added to a sweep without redoing the others
+        # returns {(pre_idxs, post_idxs, collision_window, sac_probe_latency, probe_sac_latency): ModulationTrialGroup}
+        pre_idxs = [self.pre_idxs] if pre_idxs is None else pre_idxs
+        post_idxs = [self.post_idxs] if post_idxs is None else post_idxs
+        collision_windows = [self.collision_window] if collision_windows is None else collision_windows
+        latencies = [(self.sac_probe_latency, self.probe_sac_latency)] if latencies is None else latencies
+
+        groups = {}
+        for pre, post, window, (sac_probe, probe_sac) in itertools.product(pre_idxs, post_idxs, collision_windows, latencies):
+            print(f"Sweeping trials with window (-{pre}, {post}) idxs, collision window {window}s and latencies ({sac_probe}, {probe_sac}) idxs..")
+            params = self._trial_params(pre_idxs=pre, post_idxs=post, collision_window=window, sac_probe_latency=sac_probe, probe_sac_latency=probe_sac)
+            groups[(pre, post, window, sac_probe, probe_sac)] = self._calculate_group(params)
+        return groups
+
+    def _calculate_group(self, params) -> ModulationTrialGroup:
+        entry = PrecalculationCache.entry_for(self.cache, "saccadic_trials", lambda: [self.firing_rate_bins, self.events_data], params)
+        filename = entry.path(SaccadicModulationTrialProcessor.CACHE_FILENAME)
+        if entry.exists(SaccadicModulationTrialProcessor.CACHE_FILENAME):
             print("Precalculated ModulationTrialGroup found, skipping..")
-            with open(SaccadicModulationTrialProcessor.CACHE_FILENAME, "rb") as f:
-                return pickle.load(f)
+            return ModulationTrialGroup.load(filename)
 
         # Will return [{"start": start_idx, "event": event_idx, "stop": stop_idx}, ..]
         # The indexes are the value of the bin that the timestamps fall into, so indexed into the firing rates
+        event_bins = self._shared_event_bins()
+        window = (params["pre_idxs"], params["post_idxs"])
 
         # indexes are into the firing rate
         print("Processing saccade timings..")
-        saccade_trials = self._process_timings(self.saccade_timings, self.saccade_motions, self.saccade_blocks, "saccade")
+        saccade_trials, saccade_event_idxs = self._process_timings(self.saccade_timings, self.saccade_motions, self.saccade_blocks, "saccade", *window, event_bins=event_bins["saccade"])
 
         print("Processing probe timings..")
-        probe_trials = self._process_timings(self.probe_timings, self.probe_motions, self.probe_blocks, "probe")
+        probe_trials, probe_event_idxs = self._process_timings(self.probe_timings, self.probe_motions, self.probe_blocks, "probe", *window, event_bins=event_bins["probe"])
 
         print("Filtering saccades..")
-        filt_sac_trials = self._filter_saccades_by_time([s.copy() for s in saccade_trials], [p.copy() for p in probe_trials])
+        filt_sac_trials = self._filter_saccades_by_time([s.copy() for s in saccade_trials], saccade_event_idxs, probe_event_idxs, params["sac_probe_latency"], params["probe_sac_latency"])
         print(f"Filter found {len(filt_sac_trials)} saccade trials")
         print("Demixing trials..")
-        demixed_trials = self._demix_trials(probe_trials, saccade_trials, add_saccades=False)  # Dont include since we're filtering above
+        demixed_trials = self._demix_trials(probe_trials, saccade_trials, probe_event_idxs, saccade_event_idxs, add_saccades=False,  # Dont include since we're filtering above
+                                            collision_window=params["collision_window"], drop_multiple_collisions=params["drop_multiple_collisions"])
         demixed_names, demixed_counts = np.unique([tr.trial_label for tr in demixed_trials], return_counts=True)
         for i in range(len(demixed_names)):
             print(f"Demixed {demixed_counts[i]} {demixed_names[i]} trials")
@@ -166,7 +237,7 @@ class SaccadicModulationTrialProcessor(object):
         group = ModulationTrialGroup(all_trials)
 
         print("Dumping trialgroup data to cached file..")
-        with open(SaccadicModulationTrialProcessor.CACHE_FILENAME, "wb") as f:
-            pickle.dump(group, f)
+        group.save(filename)
+        entry.complete()
 
         return group
@@ -0,0 +1,102 @@
+import numpy as np
+
+
+def find_collisions(probe_times, saccade_times, collision_window):
+    # For each probe find the saccades with |saccade_time - probe_time| <= collision_window, using windowed
+    # searchsorted counts on the sorted saccade times instead of comparing every probe with every saccade
+    # returns (saccade_idxs, num_collisions) both (probes,), saccade_idxs is the first colliding saccade in the
+    # order of saccade_times (-1 if none), num_collisions is the number of saccades in the probe's window
+    saccade_times = np.asarray(saccade_times, dtype="float64")
+    order = np.argsort(saccade_times, kind="stable")
+    return find_collisions_sorted(probe_times, saccade_times[order], order, collision_window)
+
+
+def find_collisions_sorted(probe_times, sorted_times, order, collision_window):
+    # find_collisions on already sorted saccade times, order is the saccade idx of each sorted time
+    probe_times = np.asarray(probe_times, dtype="float64")
+    sorted_times = np.asarray(sorted_times, dtype="float64")
+    order = np.asarray(order, dtype="int64")
+
+    # Compare the differences like the window check does, so probes right on the window edge collide the same way
+    lo = np.searchsorted(sorted_times, probe_times - collision_window, side="left")
+    hi = np.searchsorted(sorted_times, probe_times + collision_window, side="right")
+    lo = _adjust_edges(lo, sorted_times, probe_times, collision_window, before=True)
+    hi = _adjust_edges(hi, sorted_times, probe_times, collision_window, before=False)
+    num_collisions = np.maximum(hi - lo, 0)
+
+    saccade_idxs = np.full((len(probe_times),), -1, dtype="int64")
+    collided = np.where(num_collisions > 0)[0]
+    if len(collided) > 0:
+        # Smallest original idx of each probe's window of sorted saccades [lo, hi), with one reduceat over the
+        # window edges, the odd (between window) results are thrown away. The sentinel lets hi == len(order)
+        order_ext = np.append(order, len(order))
+        edges = np.column_stack([lo[collided], hi[collided]]).ravel()
+        saccade_idxs[collided] = np.minimum.reduceat(order_ext, edges)[::2]
+
+    return saccade_idxs, num_collisions
+
+
+def _adjust_edges(edge_idxs, sorted_times, probe_times, collision_window, before):
+    # searchsorted finds the edges with (probe -+ window), which can round differently than abs(saccade - probe),
+    # step each edge over the neighbouring saccades for as long as the two disagree
+    num = len(sorted_times)
+    if num == 0:
+        return edge_idxs
+    edge_idxs = edge_idxs.copy()
+
+    def collides(idxs):
+        return np.abs(sorted_times[np.clip(idxs, 0, num - 1)] - probe_times) <= collision_window
+
+    # Outer saccade next to the edge still collides, move the edge out to include it
+    outer_offset, step = (-1, -1) if before else (0, 1)
+    while True:
+        outer_idxs = edge_idxs + outer_offset
+        move = np.logical_and(np.logical_and(outer_idxs >= 0, outer_idxs < num), collides(outer_idxs))
+        if not np.any(move):
+            break
+        edge_idxs[move] += step
+
+    # Inner saccade next to the edge doesn't collide (and is on this edge's side of the probe), move the edge in
+    inner_offset = 0 if before else -1
+    while True:
+        inner_idxs = edge_idxs + inner_offset
+        in_bounds = np.logical_and(inner_idxs >= 0, inner_idxs < num)
+        inner_times = sorted_times[np.clip(inner_idxs, 0, num - 1)]
+        on_side = inner_times < probe_times if before else inner_times > probe_times
+        move = np.logical_and(np.logical_and(in_bounds, on_side), ~collides(inner_idxs))
+        if not np.any(move):
+            break
+        edge_idxs[move] -= step
+    return edge_idxs
+
+
+def saccades_passing_latencies(saccade_idxs, probe_idxs, sac_probe_latencies, probe_sac_latencies):
+    # Which saccades have no probe too close to them, a saccade fails if a probe is less than sac_probe_latency idxs
+    # after it, or less than probe_sac_latency idxs before it (or at the same idx). Only the nearest probe on each side
+    # can fail a saccade, which are found with searchsorted on the sorted probe idxs
+    # latencies can be scalars or equal length arrays of several settings to evaluate at once,
+    # returns a (saccades,) bool arr for scalars or (settings, saccades) for arrays
+    return saccades_passing_latencies_sorted(saccade_idxs, np.sort(np.asarray(probe_idxs, dtype="int64")), sac_probe_latencies, probe_sac_latencies)
+
+
+def saccades_passing_latencies_sorted(saccade_idxs, sorted_probes, sac_probe_latencies, probe_sac_latencies):
+    # saccades_passing_latencies with the probe idxs already sorted
+    saccade_idxs = np.asarray(saccade_idxs, dtype="int64")
+    sorted_probes = np.asarray(sorted_probes, dtype="int64")
+    sac_probe_latencies = np.asarray(sac_probe_latencies)
+    probe_sac_latencies = np.asarray(probe_sac_latencies)
+
+    # Distance to the nearest probe after the saccade, and at or before it, inf if there is none
+    after_pos = np.searchsorted(sorted_probes, saccade_idxs, side="right")
+    dist_after = np.full(saccade_idxs.shape, np.inf)
+    has_after = after_pos < len(sorted_probes)
+    dist_after[has_after] = sorted_probes[after_pos[has_after]] - saccade_idxs[has_after]
+    dist_before = np.full(saccade_idxs.shape, np.inf)
+    has_before = after_pos > 0
+    dist_before[has_before] = saccade_idxs[has_before] - sorted_probes[after_pos[has_before] - 1]
+
+    passing = np.logical_and(
+        dist_after >= sac_probe_latencies[..., None],
+        dist_before >= probe_sac_latencies[..., None]
+    )
+    return passing
@@ -0,0 +1,125 @@
+import numpy as np
+
+from population_analysis.processors.experiments.saccadic_modulation.demix import find_collisions_sorted, saccades_passing_latencies_sorted
+from population_analysis.processors.experiments.saccadic_modulation.intervals import IntervalIndex
+
+
+class EventIndex(object):
+    # Sorted event streams (eg probe and saccade timestamps, or their firing rate bin idxs) for vectorized queries
+    # of which events of one stream are near the events of another. Results are in terms of each stream's original
+    # event order, the sorting is only used internally
+    def __init__(self, streams: dict, grating_windows=None):
+        # streams is {name: (events,) times}, grating_windows is an optional [[start, end], ..] of the drifting grating
+        self.streams = {}
+        self._orders = {}
+        self._sorted = {}
+        for name, times in streams.items():
+            times = np.asarray(times)
+            self.streams[name] = times
+            self._orders[name] = np.argsort(times, kind="stable")
+            self._sorted[name] = times[self._orders[name]]
+
+        self.grating_index = None if grating_windows is None else IntervalIndex(grating_windows)
+
+    @staticmethod
+    def from_events_data(events_data) -> 'EventIndex':
+        # From the events dict of HDFSessionProcessor._event_timings
+        return EventIndex({
+            "probe": events_data["probe_timestamps"],
+            "saccade": events_data["saccade_timestamps"]
+        }, events_data["grating_windows"])
+
+    def _check_stream(self, name):
+        if name not in self.streams:
+            raise ValueError(f"No event stream '{name}'! Streams are {list(self.streams.keys())}")
+
+    def _sorted_subset(self, name, idxs=None):
+        # (sorted times, positions) of the events idxs (ascending) of a stream, positions is where each sorted time is
+        # in idxs. Taken from the already sorted stream so nothing is sorted again, None for the whole stream
+        order = self._orders[name]
+        if idxs is None:
+            return self._sorted[name], order
+        positions = np.full((len(order),), -1, dtype="int64")
+        positions[np.asarray(idxs, dtype="int64")] = np.arange(len(idxs))
+        sorted_positions = positions[order]
+        keep = sorted_positions != -1
+        return self._sorted[name][keep], sorted_positions[keep]
+
+    def _window_bounds(self, src, dst, start, end):
+        # Positions [lo, hi) into the sorted dst stream of the events with start <= dst - src <= end, for each src event
+        self._check_stream(src)
+        self._check_stream(dst)
+        src_times = self.streams[src]
+        lo = np.searchsorted(self._sorted[dst], src_times + start, side="left")
+        hi = np.searchsorted(self._sorted[dst], src_times + end, side="right")
+        return lo, np.maximum(hi, lo)
+
+    def count_in_window(self, src, dst, start, end):
+        # (src events,) number of dst events within [start, end] of each src event, relative to the src event
+        lo, hi = self._window_bounds(src, dst, start, end)
+        return hi - lo
+
+    def window_idxs(self, src, dst, start, end):
+        # List of the original idxs of the dst events within [start, end] of each src event, sorted by time
+        lo, hi = self._window_bounds(src, dst, start, end)
+        order = self._orders[dst]
+        return [order[l:h] for l, h in zip(lo, hi)]
+
+    def nearest(self, src, dst, side="both"):
+        # Nearest dst event to each src event, side is 'before' (dst <= src), 'after' (dst > src) or 'both'
+        # returns (dst_idxs, offsets) with offsets = dst_time - src_time, dst_idxs is -1 (offset NaN) if there is none
+        self._check_stream(src)
+        self._check_stream(dst)
+        if side not in ["before", "after", "both"]:
+            raise ValueError(f"Unknown side '{side}'! Choices are ['before', 'after', 'both']")
+        src_times = self.streams[src].astype("float64")
+        sorted_dst = self._sorted[dst].astype("float64")
+        after_pos = np.searchsorted(sorted_dst, src_times, side="right")
+
+        def at(pos, valid):
+            offsets = np.full(src_times.shape, np.nan)
+            offsets[valid] = sorted_dst[pos[valid]] - src_times[valid]
+            idxs = np.full(src_times.shape, -1, dtype="int64")
+            idxs[valid] = self._orders[dst][pos[valid]]
+            return idxs, offsets
+
+        before_idxs, before_offsets = at(after_pos - 1, after_pos > 0)
+        after_idxs, after_offsets = at(after_pos, after_pos < len(sorted_dst))
+        if side == "before":
+            return before_idxs, before_offsets
+        if side == "after":
+            return after_idxs, after_offsets
+
+        use_after = np.logical_or(before_idxs == -1, np.abs(after_offsets) < np.abs(before_offsets))  # Ties go before
+        use_after = np.logical_and(use_after, after_idxs != -1)
+        return np.where(use_after, after_idxs, before_idxs), np.where(use_after, after_offsets, before_offsets)
+
+    def collisions(self, src, dst, collision_window, src_idxs=None, dst_idxs=None):
+        # First dst event (in original order) within collision_window of each src event and the number of them,
+        # see demix.find_collisions. src_idxs and dst_idxs (ascending) limit both to some of their events, the
+        # returned dst idxs are then positions in dst_idxs
+        self._check_stream(src)
+        self._check_stream(dst)
+        src_times = self.streams[src] if src_idxs is None else self.streams[src][src_idxs]
+        sorted_dst, dst_positions = self._sorted_subset(dst, dst_idxs)
+        return find_collisions_sorted(src_times, sorted_dst, dst_positions, collision_window)
+
+    def passing_latencies(self, src, dst, src_dst_latencies, dst_src_latencies, src_idxs=None, dst_idxs=None):
+        # Which src events have no dst event less than src_dst_latency after them, or less than dst_src_latency
+        # before them, see demix.saccades_passing_latencies. src_idxs and dst_idxs limit both to some of their events
+        self._check_stream(src)
+        self._check_stream(dst)
+        src_values = self.streams[src] if src_idxs is None else self.streams[src][src_idxs]
+        sorted_dst, _ = self._sorted_subset(dst, dst_idxs)
+        return saccades_passing_latencies_sorted(src_values, sorted_dst, src_dst_latencies, dst_src_latencies)
+
+    def grating_blocks(self, name):
+        # Idx of the grating window each event is in, -1 if during a static grating
+        if self.grating_index is None:
+            raise ValueError("EventIndex has no grating windows!")
+        self._check_stream(name)
+        return self.grating_index.lookup(self.streams[name])
+
+    def during_static_grating(self, name):
+        # True for each event outside all of the grating windows
+        return self.grating_blocks(name) == -1
@@ -1,10 +1,12 @@
-import os
-
 import numpy as np
 
-from population_analysis.consts import BASELINE_IDXS
+from population_analysis.consts import BASELINE_IDXS, DEFAULT_PRECISION, RP_PERI_ALIGNMENTS, DEFAULT_RP_PERI_ALIGNMENT, \
+    NORMALIZER_UNIT_CHUNK_SIZE
+from population_analysis.processors.cache import PrecalculationCache, CacheEntry
 from population_analysis.processors.experiments.saccadic_modulation import ModulationTrialGroup
 from population_analysis.processors.experiments.saccadic_modulation.rp_peri_calculator import RpPeriCalculator
+from population_analysis.processors.kilosort.sparse import SparseSpikeTrains
+from population_analysis.processors.precision import precision_dtypes
 
 
 class FiringRateNormalizer(object):
@@ -13,34 +15,82 @@ class FiringRateNormalizer(object):
     RP_PERI_FIRING_RATE = "calc_rpperi_firingrates.npy"
     RP_PERI_NORMALIZED = "calc_rpperi_norm_firingrates.npy"
     LARGE_NORMALIZED = "calc_large_norm_firingrates.npy"
-
-    def __init__(self, firing_rates, trial_group: ModulationTrialGroup):
+    SPECIAL_FIRING_RATES = [
+        ("firing_rate", FIRING_RATE_FILENAME),
+        ("normalized_firing_rate", NORMALIZED_FILENAME),
+        ("rp_peri_firing_rate", RP_PERI_FIRING_RATE),
+        ("rp_peri_normalized_firing_rate", RP_PERI_NORMALIZED),
+        ("largerange_normalized_firing_rate", LARGE_NORMALIZED)
+    ]
+
+    def __init__(self, firing_rates, trial_group: ModulationTrialGroup, cache: PrecalculationCache = None, precision=DEFAULT_PRECISION, unit_chunk_size=NORMALIZER_UNIT_CHUNK_SIZE, rp_peri_alignment=DEFAULT_RP_PERI_ALIGNMENT, spikes: SparseSpikeTrains = None,
+                 rates_key=None, spikes_key=None):
         self.firing_rates = firing_rates
         self.trial_group = trial_group
+        self.cache = cache  # Where to store the precalculated firing rates, None for the current directory
+        self.precision = precision  # Key of consts.PRECISIONS, the calculated firing rates are saved as its rates dtype
+        _, self.rate_dtype = precision_dtypes(precision)
+        # Number of units to calculate at a time, the outputs are written straight into their memmapped files so
+        # peak memory is bounded by the chunk size, None to calculate all units at once
+        self.unit_chunk_size = unit_chunk_size
+        # rp_peri_alignment is a key of consts.RP_PERI_ALIGNMENTS, 'ms' aligns the saccade template using the 1ms spikes
+        if rp_peri_alignment not in RP_PERI_ALIGNMENTS:
+            raise ValueError(f"Unknown RpPeri alignment '{rp_peri_alignment}'! Choices are {RP_PERI_ALIGNMENTS}")
+        if rp_peri_alignment == "ms" and spikes is None:
+            raise ValueError("RpPeri alignment 'ms' needs the spikes!")
+        self.rp_peri_alignment = rp_peri_alignment
+        self.spikes = spikes
+        # Cache keys of the stages that calculated firing_rates and spikes (eg KilosortProcessor.firingrates_cache_key),
+        # precalculated files are keyed on these instead of hashing the arrays. None to hash the arrays with a cache
+        self.rates_key = rates_key
+        self.spikes_key = spikes_key
         self.num_units = self.firing_rates.shape[0]
         self.num_trials = self.trial_group.num_trials
 
     def _calculate_preferred_motion_direction(self, trial_firing_rates):
-        preferred = []  # (units,) arr with preferred motion dir, like [+-1, ..]
-        for unit_num in range(self.num_units):
-            # Use the value of the response between time 8-12idx (time of probe is 10) so
-            # -2*20 = -40, 2*20 = 40, (-40ms, 40ms) window
-            neg_idxs = self.trial_group.get_trial_idxs_by_motion(-1)
-            pos_idxs = self.trial_group.get_trial_idxs_by_motion(1)
-
-            neg_mean = np.abs(np.mean(np.mean(trial_firing_rates[unit_num][neg_idxs][:, 8:12], axis=0), axis=0))  # average over the trial event responses
-            pos_mean = np.abs(np.mean(np.mean(trial_firing_rates[unit_num][pos_idxs][:, 8:12], axis=0), axis=0))
-
-            if neg_mean > pos_mean:
-                preferred.append(-1)
-            else:
-                preferred.append(1)
-
-        return np.array(preferred)
-
-    def _calculate_rp_peri(self, firing_rates):
-        # firing_rates (units, trials, t)
+        # (units,) arr with preferred motion dir, like [+-1, ..]
+        # Use the value of the response between time 8-12idx (time of probe is 10) so
+        # -2*20 = -40, 2*20 = 40, (-40ms, 40ms) window
+        response = trial_firing_rates[:, :, 8:12]
+        neg_idxs = self.trial_group.get_trial_idxs_by_motion(-1)
+        pos_idxs = self.trial_group.get_trial_idxs_by_motion(1)
+
+        # Every trial has the same number of response bins, so this is the mean of the per-trial means
+        neg_mean = np.abs(np.mean(response[:, neg_idxs], axis=(1, 2), dtype="float64"))  # (units,)
+        pos_mean = np.abs(np.mean(response[:, pos_idxs], axis=(1, 2), dtype="float64"))
+
+        return np.where(neg_mean > pos_mean, -1, 1)
+
+    def _calculate_baseline_stds(self, unit_rates, preferred):
+        # (units,) std over the unit's preferred motion trials of the mean firing rate from -1000idx to -500idx
+        # (-20sec to -10sec) before each trial. The firing rates are summed between each pair of consecutive window
+        # edges, then a prefix sum over just those segment sums gives each window's sum as a single subtraction
+        trial_starts = self.trial_group.column("start_idx")
+        window_starts = trial_starts - 1000
+        window_ends = trial_starts - 500
+        assert np.all(window_starts >= 0)  # Need firing rate data before every trial for the baseline
+
+        edges = np.unique(np.concatenate([window_starts, window_ends]))  # sorted
+        # (units, edges - 1) sums of [edges[i], edges[i + 1]), summed in float64 without a float64 copy of the rates
+        segment_sums = np.add.reduceat(unit_rates[:, edges[0]:edges[-1]], edges[:-1] - edges[0], axis=1, dtype="float64")
+        prefix = np.zeros((segment_sums.shape[0], len(edges)))  # (units, edges) sum from edges[0] up to each edge
+        np.cumsum(segment_sums, axis=1, out=prefix[:, 1:])
+        start_pos = np.searchsorted(edges, window_starts)
+        end_pos = np.searchsorted(edges, window_ends)
+        window_means = (prefix[:, end_pos] - prefix[:, start_pos]) / 500  # (units, trials)
+
+        stds = np.empty((unit_rates.shape[0],))
+        for motdir in [-1, 1]:
+            unit_mask = preferred == motdir
+            trial_mask = self.trial_group.get_trial_idxs_by_motion(motdir)
+            stds[unit_mask] = np.std(window_means[unit_mask][:, trial_mask], axis=1)
+        return stds
+
+    def _calculate_rp_peri(self, firing_rates, unit_start, unit_end):
+        # firing_rates (units, trials, t) of units [unit_start, unit_end)
         rppc = RpPeriCalculator(firing_rates, self.trial_group.trial_type_idxs["saccade"], self.trial_group.trial_type_idxs["mixed"], self.trial_group)
+        if self.rp_peri_alignment == "ms":
+            return rppc.calculate_ms_aligned(self.spikes, unit_idxs=range(unit_start, unit_end))
         raw_rpp = rppc.calculate()
         return raw_rpp
 
@@ -49,103 +99,131 @@ class FiringRateNormalizer(object):
             raise ValueError("Array contains a NaN! Fix pls!")
         tw = 2
 
-    def _load_firingrates(self):
+    def _load_firingrates(self, entry: CacheEntry):
         return {
-            "firing_rate": np.load(FiringRateNormalizer.FIRING_RATE_FILENAME, mmap_mode='r'),
-            "normalized_firing_rate": np.load(FiringRateNormalizer.NORMALIZED_FILENAME, mmap_mode='r'),
-            "rp_peri_firing_rate": np.load(FiringRateNormalizer.RP_PERI_FIRING_RATE, mmap_mode='r'),
-            "rp_peri_normalized_firing_rate": np.load(FiringRateNormalizer.RP_PERI_NORMALIZED, mmap_mode='r'),
-            "largerange_normalized_firing_rate": np.load(FiringRateNormalizer.LARGE_NORMALIZED, mmap_mode='r')
+            "firing_rate": np.load(entry.path(FiringRateNormalizer.FIRING_RATE_FILENAME), mmap_mode='r'),
+            "normalized_firing_rate": np.load(entry.path(FiringRateNormalizer.NORMALIZED_FILENAME), mmap_mode='r'),
+            "rp_peri_firing_rate": np.load(entry.path(FiringRateNormalizer.RP_PERI_FIRING_RATE), mmap_mode='r'),
+            "rp_peri_normalized_firing_rate": np.load(entry.path(FiringRateNormalizer.RP_PERI_NORMALIZED), mmap_mode='r'),
+            "largerange_normalized_firing_rate": np.load(entry.path(FiringRateNormalizer.LARGE_NORMALIZED), mmap_mode='r')
         }
 
     def _subtract_baseline_rp_peri(self, rp_peri):
         # rp_peri is (units, trials, t)
         # start and end are the indexes into the arr where the baseline mean should be taken
-        baseline = np.mean(rp_peri[:, :, BASELINE_IDXS[0]:BASELINE_IDXS[1]], axis=2)  # Baseline is the first 200ms before the probe
+        baseline = np.mean(rp_peri[:, :, BASELINE_IDXS[0]:BASELINE_IDXS[1]], axis=2, dtype="float64")  # Baseline is the first 200ms before the probe
         normalized = rp_peri - baseline[:, :, None]
         return normalized
 
+    def cache_entry(self) -> CacheEntry:
+        uses_spikes = self.rp_peri_alignment == "ms"
+        params = {
+            "precision": self.precision,
+            "rp_peri_alignment": self.rp_peri_alignment,
+            "trial_group": self.trial_group,
+            "firing_rates": self.rates_key,
+            "spikes": self.spikes_key if uses_spikes else None
+        }
+        # Only hash the (large) arrays themselves when there is no key for them
+        inputs = lambda: ([self.firing_rates] if self.rates_key is None else []) + ([self.spikes] if uses_spikes and self.spikes_key is None else [])
+        return PrecalculationCache.entry_for(self.cache, "normalized_firingrates", inputs, params)
+
+    def load_cached(self, entry: CacheEntry):
+        # The precalculated firing rates of the entry, None if any of them are missing
+        print("Attempting to load a precalculated firing rate..")
+        all_cached = True
+        for nm, filen in FiringRateNormalizer.SPECIAL_FIRING_RATES:
+            if not entry.exists(filen):
+                print(f"Precalculated file '{entry.path(filen)}' doesn't exist, generating..")
+                all_cached = False
+        if all_cached:
+            return self._load_firingrates(entry)
+        return None
+
+    def _trial_layout(self):
+        # (largerange_idxs, trial_idx_len), largerange_idxs is the (trials, 35*3) idxs of each trial's large range of
+        # firing rates for misc calcs, from [-1400, +1400] rel. to event time, the response is the middle
+        trial_starts = self.trial_group.column("start_idx")
+        trial_ends = self.trial_group.column("end_idx")
+        trial_idx_len = int(trial_ends[0] - trial_starts[0])
+        assert np.all(trial_ends - trial_starts == trial_idx_len)  # Make sure each trial is the same length
+        assert np.all(trial_ends + 35 <= self.firing_rates.shape[1])  # Need to have enough firing rate data for all trials
+        assert np.all(trial_starts - 35 >= 0)
+
+        largerange_idxs = trial_starts[:, None] + np.arange(-35, trial_idx_len + 35)[None, :]
+        return largerange_idxs, trial_idx_len
+
+    @property
+    def num_rate_samples(self):
+        # Number of firing rate samples from the start of the recording needed for every trial product
+        largerange_idxs, _ = self._trial_layout()
+        return int(np.max(largerange_idxs)) + 1
+
+    def open_outputs(self, entry: CacheEntry):
+        # Every product is per unit, so preallocate the output files to fill in one chunk of units at a time
+        _, trial_idx_len = self._trial_layout()
+        num_mixed = len(self.trial_group.trial_type_idxs.get("mixed", []))
+        shapes = {
+            "firing_rate": (self.num_units, self.num_trials, trial_idx_len),
+            "normalized_firing_rate": (self.num_units, self.num_trials, trial_idx_len),
+            "rp_peri_firing_rate": (self.num_units, num_mixed, trial_idx_len),
+            "rp_peri_normalized_firing_rate": (self.num_units, num_mixed, trial_idx_len),
+            "largerange_normalized_firing_rate": (self.num_units, self.num_trials, trial_idx_len + 35 * 2)
+        }
+        outputs = {}
+        for nm, filen in FiringRateNormalizer.SPECIAL_FIRING_RATES:
+            outputs[nm] = np.lib.format.open_memmap(entry.path(filen), mode="w+", dtype=self.rate_dtype, shape=shapes[nm])
+        return outputs
+
+    def write_units(self, outputs, unit_start, unit_end, unit_rates=None):
+        # Calculate units [unit_start, unit_end) into the outputs, unit_rates is an optional (units, time) arr of their
+        # firing rates already read from the start of the recording (at least num_rate_samples long)
+        if unit_rates is None:
+            unit_rates = self.firing_rates[unit_start:unit_end]
+        largerange_idxs, trial_idx_len = self._trial_layout()
+        chunk_outputs = self._calculate_units(unit_start, unit_end, unit_rates, largerange_idxs, trial_idx_len)
+        for nm, chunk in chunk_outputs.items():
+            outputs[nm][unit_start:unit_end] = chunk
+
+    def close_outputs(self, outputs, entry: CacheEntry):
+        print("Saving firing rates to cache file..")
+        for nm in list(outputs.keys()):
+            outputs[nm].flush()
+            del outputs[nm]
+        entry.complete()
+
     def calculate(self, load_precalculated):
         # |--A-10sec---|--B-10sec---|-C-.2sec--|---Probe--|
         # baseline mean C
         # std over just A
+        entry = self.cache_entry()
+        if load_precalculated:
+            cached = self.load_cached(entry)
+            if cached is not None:
+                return cached
 
-        special_firing_rates = [
-            ("firing_rate", FiringRateNormalizer.FIRING_RATE_FILENAME),
-            ("normalized_firing_rate", FiringRateNormalizer.NORMALIZED_FILENAME),
-            ("rp_peri_firing_rate", FiringRateNormalizer.RP_PERI_FIRING_RATE),
-            ("rp_peri_normalized_firing_rate", FiringRateNormalizer.RP_PERI_NORMALIZED),
-            ("largerange_normalized_firing_rate", FiringRateNormalizer.LARGE_NORMALIZED)
-        ]
+        outputs = self.open_outputs(entry)
+        unit_chunk_size = self.num_units if self.unit_chunk_size is None else self.unit_chunk_size
+        for unit_start in range(0, self.num_units, unit_chunk_size):
+            unit_end = min(unit_start + unit_chunk_size, self.num_units)
+            print(f"Normalizing trial firing rates of units {unit_start}-{unit_end} of {self.num_units}..")
+            self.write_units(outputs, unit_start, unit_end)
+        self.close_outputs(outputs, entry)
 
-        if load_precalculated:
-            print("Attempting to load a precalculated firing rate from local directory..")
-            all_cached = True
-            for nm, filen in special_firing_rates:
-                if not os.path.exists(filen):
-                    print(f"Precalculated file '{filen}' doesn't exist, generating..")
-                    all_cached = False
-            if all_cached:
-                return self._load_firingrates()
-
-        print("Normalizing trial firing rates..", end="")
-        unit_std_groups = {i: [] for i in range(self.firing_rates.shape[0])}  # {unit_num: [<baseline mean1>, ..], ..}
-
-        all_trial_firing_rates = []  # (trials, units, t) see rpperi but with diff idxs
-        all_normalized_firing_rates = []
-        all_rp_peri_firing_rates = []  # Keep track of rp_peri calculations arr like [[[firing rates of -1000idx, end_idx for one unit], <another unit>], ..more trials]
-        all_largerange_normalized_firing_rates = []
-
-        first_trial = self.trial_group.all_trials()[0]
-        trial_idx_len = first_trial.end_idx - first_trial.start_idx
-
-        for trial_idx, trial in enumerate(self.trial_group.all_trials()):
-            if trial_idx % int(self.num_trials/10) == 0:
-                print(f" {round(trial_idx / self.num_trials, 2)*100}%", end="")
-
-            trial_start_idx = trial.start_idx
-            trial_end_idx = trial.end_idx
-            assert trial_end_idx - trial_start_idx == trial_idx_len  # Make sure each trial is the same length
-            assert trial_end_idx < self.firing_rates.shape[1]  # Need to have enough firing rate data for all trials
-            assert trial_start_idx >= 0
-
-            trial_firing_rates = []
-            trial_normalized_firing_rates = []
-            rp_peri_firing_rates = []
-            largerange_normalized_firing_rates = []  # Large range of firing rates for misc calcs, from [-1400, +1400] rel. to event time
-
-            for unit_num in range(self.num_units):
-                # regular firing rates
-                response = self.firing_rates[unit_num, trial_start_idx:trial_end_idx]
-                assert len(response) > 0
-                trial_firing_rates.append(response)
-
-                # normalized firing rates
-                baseline = self.firing_rates[unit_num, trial_start_idx + BASELINE_IDXS[0]:trial_start_idx + BASELINE_IDXS[1]]  # Mean firing rate from -200, 0ms (relative to probe)
-                assert len(baseline) > 0
-                baseline = np.mean(baseline)
-                trial_normalized_firing_rates.append(response - baseline)  # Will be adding on firingrates
-
-                # rp peri firing rates
-                # Include whole range so we can calc all stats
-                rp_peri_firing_rates.append(
-                    self.firing_rates[unit_num, trial_start_idx - 35: trial_end_idx + 35]
-                )
-
-                largerange_normalized_firing_rates.append(
-                    self.firing_rates[unit_num, trial_start_idx - 35: trial_end_idx + 35] - baseline
-                )
-
-            all_trial_firing_rates.append(trial_firing_rates)
-            all_normalized_firing_rates.append(trial_normalized_firing_rates)
-            all_rp_peri_firing_rates.append(rp_peri_firing_rates)
-            all_largerange_normalized_firing_rates.append(largerange_normalized_firing_rates)
-
-        print("")
-        all_normalized_firing_rates = np.array(all_normalized_firing_rates).swapaxes(0, 1)
-        all_trial_firing_rates = np.array(all_trial_firing_rates).swapaxes(0, 1)
-        all_rp_peri_firing_rates = np.array(all_rp_peri_firing_rates).swapaxes(0, 1)
-        all_largerange_normalized_firing_rates = np.array(all_largerange_normalized_firing_rates).swapaxes(0, 1)
+        return self._load_firingrates(entry)
+
+    def _calculate_units(self, unit_start, unit_end, unit_rates, largerange_idxs, trial_idx_len):
+        # All of the products for units [unit_start, unit_end), as {name: (units, trials, t)}
+        num_units = unit_end - unit_start
+
+        # Gather every unit's (trials, t) windows at once by indexing the time axis with a (trials, window) idx arr
+        all_rp_peri_firing_rates = np.asarray(unit_rates[:, largerange_idxs])  # (units, trials, 35*3)
+        all_trial_firing_rates = all_rp_peri_firing_rates[:, :, 35:35 + trial_idx_len]  # (units, trials, t)
+
+        # Mean firing rate from -200, 0ms (relative to probe)
+        baselines = np.mean(all_trial_firing_rates[:, :, BASELINE_IDXS[0]:BASELINE_IDXS[1]], axis=2, dtype="float64")[:, :, None]
+        all_normalized_firing_rates = all_trial_firing_rates - baselines
+        all_largerange_normalized_firing_rates = all_rp_peri_firing_rates - baselines
 
         self._check_for_nan(all_normalized_firing_rates)
         self._check_for_nan(all_trial_firing_rates)
@@ -154,37 +232,16 @@ class FiringRateNormalizer(object):
 
         preferred = self._calculate_preferred_motion_direction(all_trial_firing_rates)  # (units,)
 
-        print("Saving non-std'd firing rates to file..")
-        np.save(FiringRateNormalizer.FIRING_RATE_FILENAME, all_trial_firing_rates)
-        firing_rate_baselines = np.mean(all_trial_firing_rates[:, :, 0:10], axis=2)
+        firing_rate_baselines = np.mean(all_trial_firing_rates[:, :, 0:10], axis=2, dtype="float64")
         firing_rate_baselines = np.mean(firing_rate_baselines, axis=1)[:, None, None]  # Average over trials and set up to be broadcast onto rp_peri
-        del all_trial_firing_rates
 
-        print("Calculating RpPeri..")
-        all_rp_peri_firing_rates = self._calculate_rp_peri(all_rp_peri_firing_rates)  # comes out as (units, trials, t)
-        print("Saving RpPeri firing rates to file..")
-        np.save(FiringRateNormalizer.RP_PERI_FIRING_RATE, all_rp_peri_firing_rates)
+        all_rp_peri_firing_rates = self._calculate_rp_peri(all_rp_peri_firing_rates, unit_start, unit_end)  # comes out as (units, trials, t)
 
-        print("Normalizing all firing rates..")
         # Grab std baselines
-        for unit_num in range(self.num_units):
-            motdir = preferred[unit_num]
-
-            for trial_idx, trial in enumerate(self.trial_group.get_trials_by_motion(motdir)):
-                arrr = self.firing_rates[unit_num, trial.start_idx - 1000:trial.start_idx - 500]
-                baseline_frs = np.mean(arrr)
-                assert len(arrr) > 0
-                unit_std_groups[unit_num].append(baseline_frs)  # from -1000idx, -500idx is -20sec, -10sec
-
-        raw_unit_stds = []
-        for unit_num in range(self.num_units):
-            ustd = np.std(unit_std_groups[unit_num])
-            raw_unit_stds.append(ustd)
-
-        raw_unit_stds = np.array(raw_unit_stds)
+        raw_unit_stds = self._calculate_baseline_stds(unit_rates, preferred)
         raw_unit_stds[raw_unit_stds == 0] = 1
-        unit_stds = np.broadcast_to(raw_unit_stds[:, None, None], (self.num_units, self.num_trials, 35))
-        large_unit_stds = np.broadcast_to(raw_unit_stds[:, None, None], (self.num_units, self.num_trials, 35*3))
+        unit_stds = np.broadcast_to(raw_unit_stds[:, None, None], (num_units, self.num_trials, 35))
+        large_unit_stds = np.broadcast_to(raw_unit_stds[:, None, None], (num_units, self.num_trials, 35*3))
 
         all_normalized_firing_rates /= unit_stds
         all_largerange_normalized_firing_rates /= large_unit_stds
@@ -194,14 +251,10 @@ class FiringRateNormalizer(object):
         # Re-normalize the baseline since the subtracted RpPeri will have a different baseline (after zscoring from above)
         all_normalized_rp_peri_firing_rates = self._subtract_baseline_rp_peri(all_normalized_rp_peri_firing_rates)
 
-        print("Saving firing rates to cache file..")
-        np.save(FiringRateNormalizer.NORMALIZED_FILENAME, all_normalized_firing_rates)
-        np.save(FiringRateNormalizer.RP_PERI_NORMALIZED, all_normalized_rp_peri_firing_rates)
-        np.save(FiringRateNormalizer.LARGE_NORMALIZED, all_largerange_normalized_firing_rates)
-
-        del all_normalized_rp_peri_firing_rates
-        del all_rp_peri_firing_rates
-        del all_normalized_firing_rates
-        del all_largerange_normalized_firing_rates
-
-        return self._load_firingrates()
+        return {
+            "firing_rate": all_trial_firing_rates,
+            "normalized_firing_rate": all_normalized_firing_rates,
+            "rp_peri_firing_rate": all_rp_peri_firing_rates,
+            "rp_peri_normalized_firing_rate": all_normalized_rp_peri_firing_rates,
+            "largerange_normalized_firing_rate": all_largerange_normalized_firing_rates
+        }
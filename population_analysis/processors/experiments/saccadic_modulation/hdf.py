@@ -3,23 +3,37 @@ import os.path
 import h5py
 import numpy as np
 import pendulum
+from hdmf.backends.hdf5 import H5DataIO
 from pynwb import TimeSeries
 from pynwb.file import Subject
 from simply_nwb import SimpleNWB
 
 from population_analysis.consts import MOUSE_DETAILS, METRIC_NAMES, UNIT_ZETA_P_VALUE, SESSION_DESCRIPTION, \
     EXPERIMENTERS, EXPERIMENT_DESCRIPTION, EXPERIMENT_KEYWORDS, DEVICE_NAME, DEVICE_DESCRIPTION, DEVICE_MANUFACTURER, \
-    TOTAL_TRIAL_MS, NUM_BASELINE_POINTS, SPIKE_BIN_MS
+    TOTAL_TRIAL_MS, NUM_BASELINE_POINTS, SPIKE_BIN_MS, DEFAULT_PRECISION, DEFAULT_RP_PERI_ALIGNMENT, NWB_COMPRESSIONS, \
+    NWB_TRIAL_CHUNK_SIZE, NORMALIZER_UNIT_CHUNK_SIZE
+from population_analysis.processors.cache import PrecalculationCache
 from population_analysis.processors.experiments.saccadic_modulation import SaccadicModulationTrialProcessor
 from population_analysis.processors.experiments.saccadic_modulation.firing_rate_normalizer import FiringRateNormalizer
+from population_analysis.processors.experiments.saccadic_modulation.intervals import IntervalIndex
 from population_analysis.processors.experiments.saccadic_modulation.spikes import SpikeTrialOrganizer
+from population_analysis.processors.experiments.saccadic_modulation.trial_products import TrialProductGenerator
 from population_analysis.processors.kilosort import KilosortProcessor
 
 
 class HDFSessionProcessor(object):
-    def __init__(self, filename, mouse_name, session_id):
+    def __init__(self, filename, mouse_name, session_id, stream_chunk_size=None, num_workers=None, cache_dir=None, cache_max_bytes=None, precision=DEFAULT_PRECISION, normalizer_unit_chunk_size=NORMALIZER_UNIT_CHUNK_SIZE):
+        # stream_chunk_size is the number of spikes to read from the file at a time, None will read all spikes into memory
+        # num_workers is the number of processes to split the units across for the kilosort products, None for no processes
+        # cache_dir is a directory to keep precalculated files in, keyed by their inputs so any session can share it,
+        # cache_max_bytes bounds its size by removing the least recently used. None will use the current directory
+        # precision is a key of consts.PRECISIONS, 'compact' stores the firing rates as float32 to halve their size
+        # normalizer_unit_chunk_size is the number of units to normalize trial firing rates for at a time, None to
+        # normalize all units at once (holds every unit's firing rates in memory)
         self.raw_data = h5py.File(filename)
         self.session_id = session_id
+        self.precision = precision
+        self.normalizer_unit_chunk_size = normalizer_unit_chunk_size
 
         self.mouse_name = mouse_name
         self.mouse_name = mouse_name
@@ -27,9 +41,17 @@ class HDFSessionProcessor(object):
         self.mouse_strain = MOUSE_DETAILS[mouse_name]["strain"]
         self.mouse_sex = MOUSE_DETAILS[mouse_name]["sex"]
 
-        self.spike_clusters = np.array(self.raw_data["spikes"]["clusters"])
-        self.spike_timings = np.array(self.raw_data["spikes"]["timestamps"])
-        self.unique_unit_nums = np.unique(self.spike_clusters)
+        if stream_chunk_size is None:
+            self.spike_clusters = np.array(self.raw_data["spikes"]["clusters"])
+            self.spike_timings = np.array(self.raw_data["spikes"]["timestamps"])
+        else:
+            # Keep the datasets on disk, the KilosortProcessor will read them in chunks
+            self.spike_clusters = self.raw_data["spikes"]["clusters"]
+            self.spike_timings = self.raw_data["spikes"]["timestamps"]
+
+        self.cache = None if cache_dir is None else PrecalculationCache(cache_dir, max_bytes=cache_max_bytes)
+        self.kilosort = KilosortProcessor(self.spike_clusters, self.spike_timings, chunk_size=stream_chunk_size, num_workers=num_workers, cache=self.cache, precision=precision)
+        self.unique_unit_nums = self.kilosort.unique_units
 
         self.probe_zeta = np.array(self.raw_data["zeta"]["probe"]["left"]["p"])
         self.saccade_zeta = np.array(self.raw_data["zeta"]["saccade"]["nasal"]["p"])
@@ -45,33 +67,50 @@ class HDFSessionProcessor(object):
         assert self.raw_data["saccades"]["predicted"]["left"]["timestamps"]
         assert self.raw_data["saccades"]["predicted"]["left"]["labels"]
 
-    def save_to_nwb(self, nwb_filename, load_precalculated=True):
-        kp = KilosortProcessor(self.spike_clusters, self.spike_timings)
+    def save_to_nwb(self, nwb_filename, load_precalculated=True, smoothing=None, rp_peri_alignment=DEFAULT_RP_PERI_ALIGNMENT, compression=None, trial_chunk_size=NWB_TRIAL_CHUNK_SIZE):
+        # smoothing is an optional (kernel_name, kernel_width_ms) to build the trial firing rates from kernel smoothed
+        # rates instead of the raw binned rates, see KilosortProcessor.calculate_smoothed_firingrates
+        # rp_peri_alignment is a key of consts.RP_PERI_ALIGNMENTS, see RpPeriCalculator.calculate_ms_aligned for 'ms'
+        # compression is one of consts.NWB_COMPRESSIONS for the (units, trials, t) datasets, trial_chunk_size is the number
+        # of trials in each of their compressed chunks, see HDFSessionProcessor.nwb_dataset
+        if compression not in NWB_COMPRESSIONS:
+            raise ValueError(f"Unknown NWB compression '{compression}'! Choices are {NWB_COMPRESSIONS}")
+        if smoothing is not None and rp_peri_alignment == "ms":
+            # The 'ms' saccade template comes from the unsmoothed spikes, so it can't be subtracted from smoothed rates
+            raise ValueError("RpPeri alignment 'ms' can't be used with smoothed firing rates! Use 'bin' or no smoothing")
+        kp = self.kilosort
 
         raw_spike_times = kp.calculate_spikes(load_precalculated)
-        raw_firing_rates, fr_bins = kp.calculate_firingrates(SPIKE_BIN_MS, load_precalculated)
+        if smoothing is None:
+            raw_firing_rates, fr_bins = kp.calculate_firingrates(SPIKE_BIN_MS, load_precalculated)
+            rates_key = kp.firingrates_cache_key(SPIKE_BIN_MS)
+        else:
+            kernel_name, kernel_width_ms = smoothing
+            raw_firing_rates, fr_bins = kp.calculate_smoothed_firingrates(SPIKE_BIN_MS, kernel_name, kernel_width_ms, load_precalculated)
+            rates_key = kp.firingrates_cache_key(SPIKE_BIN_MS, kernel_name, kernel_width_ms)
+        spikes_key = kp.spikes_cache_key()
 
         grating_windows = self._calc_grating_windows(self.raw_data)
         # Grab the trials for the events
         events = self._event_timings(grating_windows)
 
         # Separate the trials into Rs, RpExtra and Rmixed
-        smp = SaccadicModulationTrialProcessor(fr_bins, events)
+        smp = SaccadicModulationTrialProcessor(fr_bins, events, cache=self.cache)
         trialgroup = smp.calculate()
         trial_spike_duration_idxs = self._calc_trial_spike_duration_idxs(trialgroup)
 
-        trial_firing_rates = FiringRateNormalizer(raw_firing_rates, trialgroup)
-        all_firing_rates = trial_firing_rates.calculate(load_precalculated)
-
-        spike_organizer = SpikeTrialOrganizer(raw_spike_times, trialgroup)
-        trial_spike_times = spike_organizer.calculate(load_precalculated)
+        trial_firing_rates = FiringRateNormalizer(raw_firing_rates, trialgroup, cache=self.cache, precision=self.precision, unit_chunk_size=self.normalizer_unit_chunk_size, rp_peri_alignment=rp_peri_alignment, spikes=raw_spike_times,
+                                                 rates_key=rates_key, spikes_key=spikes_key)
+        spike_organizer = SpikeTrialOrganizer(raw_spike_times, trialgroup, cache=self.cache, spikes_key=spikes_key)
+        # Both are calculated in one pass over the units' firing rates and spikes
+        all_firing_rates, trial_spike_times = TrialProductGenerator(trial_firing_rates, spike_organizer).calculate(load_precalculated)
 
         print("Creating NWB..")
         nwb = self._initialize_nwb()
         behavior_events = nwb.create_processing_module(name="behavior", description="Contains saccade and probe event timings")
 
         print("Adding firing rates and spikes..")
-        self._add_rates_nwb(nwb, all_firing_rates, trial_spike_times, trial_spike_duration_idxs)
+        self._add_rates_nwb(nwb, all_firing_rates, trial_spike_times, trial_spike_duration_idxs, compression, trial_chunk_size)
 
         print("Adding experiment and behavior data..")
         self._add_metrics_nwb(behavior_events)
@@ -82,8 +121,8 @@ class HDFSessionProcessor(object):
         SimpleNWB.write(nwb, nwb_filename)
         print("Clearing memmaps..")
         raw_firing_rates._mmap.close()
-        raw_spike_times._mmap.close()
-        trial_spike_times._mmap.close()
+        raw_spike_times.close()
+        trial_spike_times.close()
         for _, val in all_firing_rates.items():
             val._mmap.close()
         del raw_spike_times
@@ -93,19 +132,28 @@ class HDFSessionProcessor(object):
         print("Done!")
 
     def _calc_trial_spike_duration_idxs(self, trialgroup):
-        dur = []
-        for tr in trialgroup.all_trials():
-            dur.append([tr.start_idx*SPIKE_BIN_MS, tr.end_idx*SPIKE_BIN_MS])
-        return np.array(dur)
-
-    def _add_rates_nwb(self, nwb, all_firing_rates, trial_spike_times, trial_spike_duration_idxs):
+        return np.column_stack([trialgroup.column("start_idx"), trialgroup.column("end_idx")]) * SPIKE_BIN_MS
+
+    @staticmethod
+    def nwb_dataset(content, compression=None, trial_chunk_size=NWB_TRIAL_CHUNK_SIZE):
+        # Wrap a (units, trials, t) arr in compressed H5DataIO chunked as (1 unit, trial_chunk_size trials, all t), so
+        # per-unit and trial block reads only decompress the chunks they need, None for a chunk per unit. Uncompressed
+        # and other arrs are written as they are, contiguous reads are faster (see scripts/benchmark_nwb_layouts.py)
+        if compression is None or np.ndim(content) != 3 or 0 in content.shape:
+            return content
+        if trial_chunk_size is None:
+            trial_chunk_size = content.shape[1]
+        chunks = (1, min(trial_chunk_size, content.shape[1]), content.shape[2])
+        return H5DataIO(data=content, chunks=chunks, compression=compression, shuffle=compression is not None)
+
+    def _add_rates_nwb(self, nwb, all_firing_rates, trial_spike_times, trial_spike_duration_idxs, compression=None, trial_chunk_size=NWB_TRIAL_CHUNK_SIZE):
         datas = [
             ("large_range_normalized_firing_rates", all_firing_rates["largerange_normalized_firing_rate"]),
             ("trial_response_firing_rates", all_firing_rates["firing_rate"]),
             ("normalized_trial_response_firing_rates", all_firing_rates["normalized_firing_rate"]),
             ("trial_rp_peri_response_firing_rates", all_firing_rates["rp_peri_firing_rate"]),
             ("normalized_trial_rp_peri_response_firing_rates", all_firing_rates["rp_peri_normalized_firing_rate"]),
-            ("trial_spike_times", trial_spike_times),
+            ("trial_spike_times", trial_spike_times.packed),  # Bit-packed along time, see PackedSpikeTrials
             ("unit_labels", self.unique_unit_nums),
             ("probe_zeta_scores", self.probe_zeta),
             ("saccade_zeta_scores", self.saccade_zeta),
@@ -115,7 +163,8 @@ class HDFSessionProcessor(object):
         for idx, d in enumerate(datas):
             name, content = d
             print(f"Processing {name}..")
-            nwb.processing["behavior"].add(TimeSeries(name=name, data=content, rate=1.0, unit="spikes", description=name))
+            data = HDFSessionProcessor.nwb_dataset(content, compression, trial_chunk_size)
+            nwb.processing["behavior"].add(TimeSeries(name=name, data=data, rate=1.0, unit="spikes", description=name))
 
     def _add_trial_type_idxs(self, behavior_events, trialgroup):
         trial_types = trialgroup.get_trials_attribute("trial_label")
@@ -125,11 +174,7 @@ class HDFSessionProcessor(object):
                                            data=np.where(trial_types == trial_type)[0], rate=1.0, unit="idx",
                                            description=f"Indices into all trials that are {trial_type} trials."))
         # Relative timestamps for mixed trials
-        mixed_trial_relative_timings = []
-        for tr in trialgroup.get_trials_by_type("mixed"):
-            mixed_trial_relative_timings.append(tr.events["saccade_time"] - tr.events["probe_time"])
-
-        mixed_trial_relative_timings = np.array(mixed_trial_relative_timings)
+        mixed_trial_relative_timings = trialgroup.saccade_latencies()[trialgroup.select(trial_type="mixed")]
         behavior_events.add(TimeSeries(
                 name=f"mixed-trial-saccade-relative-timestamps",
                 data=mixed_trial_relative_timings, rate=0.001, unit="s",
@@ -140,12 +185,18 @@ class HDFSessionProcessor(object):
         behavior_events.add(TimeSeries(name="probes", data=events["probe_timestamps"], unit="s", rate=0.001, description="Timestamps of the probe"))
         behavior_events.add(TimeSeries(name="saccades", data=events["saccade_timestamps"], unit="s", rate=0.001, description="Timestamps of the saccades"))
 
-        behavior_events.add(TimeSeries(name="spike_clusters", data=self.spike_clusters, unit="num", rate=1.0, description="Spike cluster assignments for the spike timings"))
-        behavior_events.add(TimeSeries(name="spike_timestamps", data=self.spike_timings, unit="num", rate=1.0, description="Timestamps of each spike corresponding to the spike clusters"))
+        behavior_events.add(TimeSeries(name="spike_clusters", data=self._spike_data(self.spike_clusters), unit="num", rate=1.0, description="Spike cluster assignments for the spike timings"))
+        behavior_events.add(TimeSeries(name="spike_timestamps", data=self._spike_data(self.spike_timings), unit="num", rate=1.0, description="Timestamps of each spike corresponding to the spike clusters"))
 
         behavior_events.add(TimeSeries(name="trial_motion_directions", data=trialgroup.get_trials_attribute("motion_direction"), unit="motion", rate=1.0, description="Motion direction of the drifting grating"))
         behavior_events.add(TimeSeries(name="trial_block_idx", data=trialgroup.get_trials_attribute("block_idx"), unit="idxs", rate=1.0, description="Which block of drifting grating did the trial occur in"))
 
+    def _spike_data(self, data):
+        if isinstance(data, h5py.Dataset):
+            # Streaming, have the NWB writer copy the dataset over from the raw file instead of reading it into memory
+            return H5DataIO(data=data, link_data=False)
+        return data
+
     def _add_metrics_nwb(self, event_module):
         for metric_name, metric_data in self.metrics.items():
             ts = TimeSeries(name=f"metric-{metric_name}", data=metric_data, unit="num", rate=1.0, description=f"Quality metric {metric_name}")
@@ -198,20 +249,20 @@ class HDFSessionProcessor(object):
 
     def _calc_grating_windows(self, raw_data):
         # zip up timestamps of the drifting grating with the corresponding iti (inter time intervals) to give [[grating_start, grating_stop], ..]
-        window_timestamps = np.array(list(zip(list(raw_data["stimuli"]["dg"]["grating"]["timestamps"]),
-                                              list(raw_data["stimuli"]["dg"]["iti"]["timestamps"]))))
-        inter_grating_timestamps = []
-        for i in range(1, len(window_timestamps)):
-            _, last_stop = window_timestamps[i - 1]
-            next_start, _ = window_timestamps[i]
-            inter_grating_timestamps.append([last_stop, next_start])
+        grating_starts = np.array(raw_data["stimuli"]["dg"]["grating"]["timestamps"])
+        grating_stops = np.array(raw_data["stimuli"]["dg"]["iti"]["timestamps"])
+        num_windows = min(len(grating_starts), len(grating_stops))
+        window_timestamps = np.column_stack([grating_starts[:num_windows], grating_stops[:num_windows]])
 
-        inter_grating_timestamps = np.array(
-            inter_grating_timestamps)  # Timestamps of no motion of the drifting grating in [[dg_stop, dg_start], ..]
+        grating_index = IntervalIndex(window_timestamps)
+        static_index = grating_index.gaps()
+        inter_grating_timestamps = static_index.windows  # Timestamps of no motion of the drifting grating in [[dg_stop, dg_start], ..]
 
         return {
             "grating_timestamps": window_timestamps,
-            "inter_grating_timestamps": inter_grating_timestamps
+            "inter_grating_timestamps": inter_grating_timestamps,
+            "grating_index": grating_index,
+            "static_index": static_index  # Use static_index.contains(times) for times during a static grating
         }
 
     def _event_timings(self, grating_windows):
@@ -259,21 +310,12 @@ class HDFSessionProcessor(object):
         if windows.shape[0] != motions.shape[0]:
             raise ValueError(f"Windows shape {windows.shape} != Motions shape {motions.shape} !")
 
-        calcd = []
-        passing_idxs = []
-        for tidx, timestamp in enumerate(timestamps):
-            for widx, window in enumerate(windows):
-                w_start, w_end = window
-                if w_start <= timestamp <= w_end:
-                    calcd.append(motions[widx])
-                    passing_idxs.append(tidx)
-                    break
+        window_idxs = IntervalIndex(windows).lookup(timestamps)
+        passing_idxs = np.where(window_idxs != -1)[0]
+        calcd = motions[window_idxs[passing_idxs]]
 
         print(f"Found {len(timestamps) - len(calcd)} timestamps during static grating for {name}, excluding..")
-        calcd = np.array(calcd)
         # filter out timestamps during static grating by not including ones that aren't in the window by passing index
-        passing_idxs = np.array(passing_idxs)
         filtered_timestamps = timestamps[passing_idxs]
 
         return filtered_timestamps, calcd, passing_idxs
-
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class IntervalIndex(object):
+    # Lookup of which [start, end] window (inclusive) times fall into, with a searchsorted on the window starts and a
+    # check against that window's end. Windows can't overlap, but can touch, a time on a shared edge is in the first
+    def __init__(self, windows):
+        # windows is [[start, end], ..] (windows, 2)
+        self.windows = np.asarray(windows, dtype="float64").reshape((-1, 2))
+        self.order = np.argsort(self.windows[:, 0], kind="stable")  # Window idxs sorted by start
+        self.starts = self.windows[self.order, 0]
+        self.ends = self.windows[self.order, 1]
+
+        if np.any(self.ends < self.starts):
+            raise ValueError("Interval windows must have start <= end!")
+        if np.any(self.starts[1:] < self.ends[:-1]):
+            raise ValueError("Interval windows can't overlap!")
+
+    def __len__(self):
+        return len(self.windows)
+
+    def lookup(self, times):
+        # Index of the window each time is in, -1 if it isn't in any window
+        times = np.asarray(times, dtype="float64")
+        if len(self) == 0:
+            return np.full(times.shape, -1, dtype="int64")  # eg the gaps() of a single window
+        pos = np.searchsorted(self.starts, times, side="right") - 1  # Last window starting at or before each time
+        if len(self) > 1:
+            # On an edge shared with the previous window, that one comes first
+            prev_pos = np.clip(pos - 1, 0, len(self) - 1)
+            on_prev = np.logical_and(pos > 0, times <= self.ends[prev_pos])
+            pos[on_prev] -= 1
+
+        inside = np.logical_and(pos >= 0, times <= self.ends[np.clip(pos, 0, None)])
+        window_idxs = np.full(times.shape, -1, dtype="int64")
+        window_idxs[inside] = self.order[pos[inside]]
+        return window_idxs
+
+    def contains(self, times):
+        # True for each time inside any window
+        return self.lookup(times) != -1
+
+    def gaps(self) -> 'IntervalIndex':
+        # Index of the spaces between consecutive windows, [[window_end, next_window_start], ..]
+        return IntervalIndex(np.column_stack([self.ends[:-1], self.starts[1:]]))
@@ -2,6 +2,7 @@ import numpy as np
 
 from population_analysis.consts import SPIKE_BIN_MS
 from population_analysis.processors.experiments.saccadic_modulation import ModulationTrialGroup
+from population_analysis.processors.kilosort.sparse import SparseSpikeTrains
 
 
 class RpPeriCalculator(object):
@@ -32,28 +33,54 @@ class RpPeriCalculator(object):
 
         return mixed_peri_waveforms
 
+    def _mixed_offsets(self):
+        # (mixed trials,) start idx of each mixed trial's saccade template in the averaged saccade waveform, in [0, 70]
+        mixed_latencies = self.trialgroup.saccade_latencies()[self.trialgroup.trial_type_idxs["mixed"]]  # In seconds
+        offsets = np.trunc(np.round(mixed_latencies, 3)*1000)  # Round to .000 and turn into ms
+        offsets = np.round(offsets / SPIKE_BIN_MS, 0)  # Figure out how many indexes away the relative saccade is
+        offsets = np.clip(offsets, -35, 35).astype(int)
+        return 35 - offsets
+
     # def calculate_timeshifted_rp_peri(self):
     def calculate(self):
         saccade_unit_trial_waveforms = self.fr[:, self.sac_idxs]  # (units, trials, t))
 
         # average is now units x t
         saccade_unit_average_waveforms = np.average(saccade_unit_trial_waveforms, axis=1)  # Average over saccade trials for each unit
-        all_mixed_peri_waveforms = []  # Will end up being (trials, units, t) will swapaxes to (units, trials, t)
-
-        for tr_idx, tr in enumerate(self.trialgroup.get_trials_by_type("mixed")):
-            offset = tr.events["saccade_time"] - tr.events["probe_time"]  # Will be in seconds
-            offset = int(round(offset, 3)*1000)  # Round to .000 and turn into ms
-            offset = int(round(offset / SPIKE_BIN_MS, 0))  # Figure out how many indexes away the relative saccade is
-            offset = int(np.clip(offset, -35, 35))
-            offset = (-1*offset)
-            sac_wv = saccade_unit_average_waveforms[:, 35 + offset:offset + 35 + 35]  # 35 long waveform snippet
-            mixed_peri_wavs = []
-            for unit_num in range(self.fr.shape[0]):
-                unit_trial_fr = self.fr[unit_num, self.mix_idxs[tr_idx], 35:35 + 35]  # actually is 0-35 but offset for neg
-                rpperi = unit_trial_fr - sac_wv[unit_num, :]  # Subtract off each RpPeri for each trial specific to the offset of the saccade from the probe
-                mixed_peri_wavs.append(rpperi)
-
-            all_mixed_peri_waveforms.append(mixed_peri_wavs)
-        all_mixed_peri_waveforms = np.array(all_mixed_peri_waveforms).swapaxes(0, 1)  # Swap units trials so its (units, trials, t)
+
+        # Every 35 long saccade waveform snippet a mixed trial can subtract, one per possible offset (units, 71, 35)
+        templates = np.lib.stride_tricks.sliding_window_view(saccade_unit_average_waveforms, 35, axis=1)
+
+        # Subtract off each RpPeri for each trial specific to the offset of the saccade from the probe
+        mixed_unit_trial_fr = self.fr[:, self.mix_idxs, 35:35 + 35]  # (units, trials, t) actually is 0-35 but offset for neg
+        all_mixed_peri_waveforms = mixed_unit_trial_fr - templates[:, self._mixed_offsets()]
 
         return all_mixed_peri_waveforms
+
+    def _mixed_offsets_ms(self):
+        # (mixed trials,) saccade offset of each mixed trial to the nearest ms, clipped to the same range as _mixed_offsets
+        window_ms = self.window_size * SPIKE_BIN_MS
+        mixed_latencies = self.trialgroup.saccade_latencies()[self.trialgroup.trial_type_idxs["mixed"]]  # In seconds
+        return np.clip(np.round(mixed_latencies * 1000), -window_ms, window_ms).astype(int)
+
+    def calculate_ms_aligned(self, spikes: SparseSpikeTrains, unit_idxs=None):
+        # Like calculate, but the saccade template is shifted by each mixed trial's exact saccade offset in ms instead
+        # of the nearest SPIKE_BIN_MS bin. The saccade average is taken from the 1ms spike flags and only rebinned
+        # after shifting. unit_idxs are the units of spikes that the rows of firing_rates are, None for all
+        unit_idxs = range(self.fr.shape[0]) if unit_idxs is None else unit_idxs
+        window_ms = self.window_size * SPIKE_BIN_MS
+
+        # Sum of the saccade trials' spike flags at each ms of the [-t, 0, t*2] window (units, t*3 in ms)
+        saccade_starts = (self.trialgroup.column("start_idx")[self.sac_idxs] - self.window_size) * SPIKE_BIN_MS
+        saccade_sums = spikes.summed_windows(saccade_starts, window_ms * 3, unit_idxs=unit_idxs)
+        prefix = np.zeros((saccade_sums.shape[0], saccade_sums.shape[1] + 1))
+        np.cumsum(saccade_sums, axis=1, out=prefix[:, 1:])
+
+        # Build each distinct offset's template once, rebinned into SPIKE_BIN_MS bins from the prefix sum
+        offsets, offset_idxs = np.unique(self._mixed_offsets_ms(), return_inverse=True)
+        edges = (window_ms - offsets)[:, None] + np.arange(self.window_size + 1)[None, :] * SPIKE_BIN_MS  # (offsets, t+1)
+        templates = np.diff(prefix[:, edges], axis=2)  # (units, offsets, t) spike counts
+        templates /= len(self.sac_idxs) * SPIKE_BIN_MS  # Average over saccade trials, in spikes per ms like the rates
+
+        mixed_unit_trial_fr = self.fr[:, self.mix_idxs, 35:35 + 35]  # (units, trials, t)
+        return mixed_unit_trial_fr - templates[:, offset_idxs]
@@ -1,38 +1,69 @@
-import os
-
 import numpy as np
 
 from population_analysis.consts import SPIKE_BIN_MS
+from population_analysis.processors.cache import PrecalculationCache, CacheEntry
 from population_analysis.processors.experiments.saccadic_modulation import ModulationTrialGroup
+from population_analysis.processors.kilosort.packed import PackedSpikeTrials
+from population_analysis.processors.kilosort.sparse import SparseSpikeTrains
 
 
 class SpikeTrialOrganizer(object):
-    SPIKE_TRIALS_FILENAME = "calc_spike_trials.npy"
+    SPIKE_TRIALS_FILENAME = "calc_packed_spike_trials.npy"
 
-    def __init__(self, raw_spike_times, trialgroup: ModulationTrialGroup):
+    def __init__(self, raw_spike_times: SparseSpikeTrains, trialgroup: ModulationTrialGroup, cache: PrecalculationCache = None, spikes_key=None):
         self.all_spikes = raw_spike_times
         self.trialgroup = trialgroup
+        self.cache = cache  # Where to store the precalculated spike trials, None for the current directory
+        self.spikes_key = spikes_key  # Cache key of the spikes (KilosortProcessor.spikes_cache_key), None to hash them
+
+    def _trial_windows(self):
+        # (starts, trial_len) of the trial windows in ms
+        starts = self.trialgroup.column("start_idx") * SPIKE_BIN_MS  # trial idxs are into the 20ms bins, spikes are in 1ms
+        trial_len = int(self.trialgroup.column("end_idx")[0] - self.trialgroup.column("start_idx")[0]) * SPIKE_BIN_MS
+        return starts, trial_len
+
+    def cache_entry(self) -> CacheEntry:
+        params = {"spike_bin_ms": SPIKE_BIN_MS, "trial_group": self.trialgroup, "spikes": self.spikes_key}
+        return PrecalculationCache.entry_for(self.cache, "spike_trials", lambda: [self.all_spikes] if self.spikes_key is None else [], params)
+
+    def load_cached(self, entry: CacheEntry):
+        # The precalculated spike trials of the entry, None if they are missing
+        print("Attempting to load a precalculated spike trials..")
+        if entry.exists(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME):
+            _, trial_len = self._trial_windows()
+            return PackedSpikeTrials.load(entry.path(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME), trial_len)
+        print(f"Precalculated file does not exist, generating..")
+        return None
+
+    def open_output(self, entry: CacheEntry):
+        # Preallocate the packed (units, trials, ceil(700 / 8)) output file
+        starts, trial_len = self._trial_windows()
+        num_units = self.all_spikes.shape[0]
+        return np.lib.format.open_memmap(entry.path(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME), mode="w+", dtype="uint8", shape=(num_units, len(starts), int(np.ceil(trial_len / 8))))
 
-    def calculate(self, load_precalculated):
+    def write_units(self, packed, unit_start, unit_end):
+        # Pack units [unit_start, unit_end) trial windows straight from their spikes into the output
+        starts, trial_len = self._trial_windows()
+        self.all_spikes.packed_trial_windows(starts, trial_len, unit_idxs=range(unit_start, unit_end), out=packed[unit_start:unit_end])
+
+    def close_output(self, packed, entry: CacheEntry):
+        packed.flush()
+        del packed
+        entry.complete()
+
+    def calculate(self, load_precalculated) -> PackedSpikeTrials:
+        entry = self.cache_entry()
         if load_precalculated:
-            print("Attempting to load a precalculated spike trials from local directory..")
-            if os.path.exists(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME):
-                return np.load(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME, mmap_mode='r')
-            else:
-                print(f"Precalculated file does not exist, generating..")
-
-        all_spike_trials = []
-        for tr in self.trialgroup.all_trials():
-            units_spike_trial = []
-            for unit_idx in range(self.all_spikes.shape[0]):
-                val = self.all_spikes[unit_idx, tr.start_idx*SPIKE_BIN_MS:tr.end_idx*SPIKE_BIN_MS]  # spikes are binned in 20ms bins
-                units_spike_trial.append(val)
-            all_spike_trials.append(units_spike_trial)
-        all_spike_trials = np.array(all_spike_trials).swapaxes(0, 1)  # want them in (units, trials, 700)
-
-        with open(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME, "wb") as f:
-            np.save(f, all_spike_trials)
-        del all_spike_trials
-
-        all_spike_trials = np.load(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME, mmap_mode='r')
-        return all_spike_trials
+            cached = self.load_cached(entry)
+            if cached is not None:
+                return cached
+
+        # Pack each unit's trial windows straight from its spikes into the memmapped output, so the unpacked
+        # (units, trials, 700) arr never exists in memory
+        packed = self.open_output(entry)
+        for unit_idx in range(self.all_spikes.shape[0]):
+            self.write_units(packed, unit_idx, unit_idx + 1)
+        self.close_output(packed, entry)
+
+        _, trial_len = self._trial_windows()
+        return PackedSpikeTrials.load(entry.path(SpikeTrialOrganizer.SPIKE_TRIALS_FILENAME), trial_len)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from population_analysis.consts import NORMALIZER_UNIT_CHUNK_SIZE
+from population_analysis.processors.experiments.saccadic_modulation.firing_rate_normalizer import FiringRateNormalizer
+from population_analysis.processors.experiments.saccadic_modulation.spikes import SpikeTrialOrganizer
+
+
+class TrialProductGenerator(object):
+    # Calculates the FiringRateNormalizer and SpikeTrialOrganizer products in a single pass over the units, reading
+    # each chunk of units' firing rates once for the response, normalized, largerange, RpPeri and baseline std windows
+    # and packing their spike windows alongside. Writes into the same cache entries as the separate stages, so either
+    # can load what the other calculated
+    def __init__(self, normalizer: FiringRateNormalizer, spike_organizer: SpikeTrialOrganizer):
+        if normalizer.num_units != spike_organizer.all_spikes.shape[0]:
+            raise ValueError(f"Firing rates have {normalizer.num_units} units but the spikes have {spike_organizer.all_spikes.shape[0]}!")
+        self.normalizer = normalizer
+        self.spike_organizer = spike_organizer
+
+    def calculate(self, load_precalculated):
+        # Returns (firing rates dict like FiringRateNormalizer.calculate, PackedSpikeTrials)
+        rates_entry = self.normalizer.cache_entry()
+        spikes_entry = self.spike_organizer.cache_entry()
+        if load_precalculated:
+            firing_rates = self.normalizer.load_cached(rates_entry)
+            spike_trials = self.spike_organizer.load_cached(spikes_entry)
+            if firing_rates is not None and spike_trials is not None:
+                return firing_rates, spike_trials
+            # Only one stage is missing, calculate it on its own instead of redoing both
+            if firing_rates is not None:
+                return firing_rates, self.spike_organizer.calculate(False)
+            if spike_trials is not None:
+                return self.normalizer.calculate(False), spike_trials
+
+        rate_outputs = self.normalizer.open_outputs(rates_entry)
+        packed = self.spike_organizer.open_output(spikes_entry)
+
+        num_units = self.normalizer.num_units
+        num_rate_samples = self.normalizer.num_rate_samples
+        # Each chunk's rates are read into memory whole, so always use a bounded block of units even when the
+        # normalizer is set to calculate all units at once
+        unit_chunk_size = self.normalizer.unit_chunk_size or NORMALIZER_UNIT_CHUNK_SIZE
+        for unit_start in range(0, num_units, unit_chunk_size):
+            unit_end = min(unit_start + unit_chunk_size, num_units)
+            print(f"Calculating trial products of units {unit_start}-{unit_end} of {num_units}..")
+            unit_rates = np.asarray(self.normalizer.firing_rates[unit_start:unit_end, :num_rate_samples])  # Single read
+            self.normalizer.write_units(rate_outputs, unit_start, unit_end, unit_rates=unit_rates)
+            self.spike_organizer.write_units(packed, unit_start, unit_end)
+
+        self.normalizer.close_outputs(rate_outputs, rates_entry)
+        self.spike_organizer.close_output(packed, spikes_entry)
+
+        return self.normalizer.load_cached(rates_entry), self.spike_organizer.load_cached(spikes_entry)
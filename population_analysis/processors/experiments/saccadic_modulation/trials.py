@@ -2,24 +2,92 @@ import numpy as np
 
 
 class ModulationTrialGroup(object):
+    # Columnar table of trials, one array per trial attribute instead of a ModulationTrial object per trial
+    # Columns are (trials,) arrays, the saccade_* columns are only set for mixed trials (-1 or NaN otherwise)
+    TRIAL_LABELS = ["saccade", "probe", "mixed"]  # label_code is the index into this
+    INT_COLUMNS = ["start_idx", "end_idx", "event_idx", "label_code", "motion_direction", "block_idx", "saccade_start", "saccade_event", "saccade_end"]
+    FLOAT_COLUMNS = ["event_time", "saccade_time"]
+    # Names of the ModulationTrial attributes, and mixed trial events, that aren't named the same as their column
+    ATTRIBUTE_COLUMNS = {"block_num": "block_idx", "probe_start": "start_idx", "probe_event": "event_idx", "probe_end": "end_idx", "probe_time": "event_time"}
+
     def __init__(self, trial_list: list['ModulationTrial']):
-        self._trials = np.array(trial_list)
-        self.trial_labels = np.array([tr.trial_label for tr in trial_list])
-        self.trial_motion_directions = np.array([tr.motion_direction for tr in trial_list])
+        columns = {col: [] for col in ModulationTrialGroup.INT_COLUMNS + ModulationTrialGroup.FLOAT_COLUMNS}
+        for tr in trial_list:
+            columns["start_idx"].append(tr.start_idx)
+            columns["end_idx"].append(tr.end_idx)
+            columns["event_idx"].append(tr.event_idx)
+            columns["event_time"].append(tr.event_time)
+            columns["label_code"].append(ModulationTrialGroup.TRIAL_LABELS.index(tr.trial_label))
+            columns["motion_direction"].append(tr.motion_direction)
+            columns["block_idx"].append(tr.block_idx)
+            for col, missing in [("saccade_start", -1), ("saccade_event", -1), ("saccade_end", -1), ("saccade_time", np.nan)]:
+                columns[col].append(tr.events.get(col, missing))
+        self._set_columns(columns)
+
+    @staticmethod
+    def from_columns(columns: dict) -> 'ModulationTrialGroup':
+        group = ModulationTrialGroup.__new__(ModulationTrialGroup)
+        group._set_columns(columns)
+        return group
+
+    @staticmethod
+    def load(filename) -> 'ModulationTrialGroup':
+        with np.load(filename) as data:
+            return ModulationTrialGroup.from_columns({k: data[k] for k in data.files})
+
+    def save(self, filename):
+        np.savez(filename, **self.columns)
+
+    def _set_columns(self, columns):
+        self.columns = {}
+        for col in ModulationTrialGroup.INT_COLUMNS:
+            self.columns[col] = np.asarray(columns[col], dtype="int64")
+        for col in ModulationTrialGroup.FLOAT_COLUMNS:
+            self.columns[col] = np.asarray(columns[col], dtype="float64")
+
+        self.trial_labels = np.array(ModulationTrialGroup.TRIAL_LABELS)[self.columns["label_code"]]
+        self.trial_motion_directions = self.columns["motion_direction"]
         self.trial_types = np.unique(self.trial_labels)
         self.trial_type_idxs = {}
-
         for trial_type in self.trial_types:
-            idxs = np.where(self.trial_labels == trial_type)[0]
-            self.trial_type_idxs[trial_type] = idxs
-
-        tw = 2
+            self.trial_type_idxs[trial_type] = np.where(self.trial_labels == trial_type)[0]
+        self._trials = None  # ModulationTrial objects, only made if all_trials() is used
 
     def __str__(self):
-        return f"TrialGroup({[(k,len(v)) for k,v in self.trial_type_idxs]})"
+        return f"TrialGroup({[(k, len(v)) for k, v in self.trial_type_idxs.items()]})"
+
+    def column(self, name):
+        # (trials,) arr of a column, or a ModulationTrial attribute / mixed trial event name
+        if name == "trial_label":
+            return self.trial_labels
+        return self.columns[ModulationTrialGroup.ATTRIBUTE_COLUMNS.get(name, name)]
+
+    def saccade_latencies(self):
+        # Time in seconds from the probe to the saccade of each trial, NaN for non-mixed trials
+        return self.columns["saccade_time"] - self.columns["event_time"]
+
+    def select(self, trial_type=None, motion_direction=None, min_latency=None, max_latency=None):
+        # Idxs of the trials matching all of the given conditions, latencies (seconds, see saccade_latencies) only
+        # match mixed trials and are inclusive
+        passing = np.ones((self.num_trials,), dtype=bool)
+        if trial_type is not None:
+            passing &= self.trial_labels == trial_type
+        if motion_direction is not None:
+            passing &= self.trial_motion_directions == motion_direction
+        if min_latency is not None or max_latency is not None:
+            latencies = self.saccade_latencies()
+            passing &= ~np.isnan(latencies)
+            if min_latency is not None:
+                passing &= latencies >= min_latency
+            if max_latency is not None:
+                passing &= latencies <= max_latency
+        return np.where(passing)[0]
+
+    def subset(self, trial_idxs) -> 'ModulationTrialGroup':
+        return ModulationTrialGroup.from_columns({k: v[trial_idxs] for k, v in self.columns.items()})
 
     def get_trials_by_type(self, trial_type):
-        return self._trials[self.trial_type_idxs[trial_type]]
+        return self.all_trials()[self.trial_type_idxs[trial_type]]
 
     def get_trial_idxs_by_motion(self, motion_direction):
         idxs = self.trial_motion_directions == motion_direction
@@ -27,21 +95,38 @@ class ModulationTrialGroup(object):
 
     def get_trials_by_motion(self, motion_direction):
         idxs = self.get_trial_idxs_by_motion(motion_direction)
-        return self._trials[idxs]
+        return self.all_trials()[idxs]
 
     @property
     def num_trials(self):
-        return len(self._trials)
+        return len(self.columns["start_idx"])
 
     def all_trials(self) -> np.ndarray:
+        # Object arr of ModulationTrials, prefer using the columns directly
+        if self._trials is None:
+            trials = []
+            for idx in range(self.num_trials):
+                label = self.trial_labels[idx]
+                events = {}
+                if label == "mixed":
+                    for name in ["probe_start", "probe_event", "probe_end", "probe_time", "saccade_start", "saccade_event", "saccade_end", "saccade_time"]:
+                        events[name] = self.column(name)[idx]
+                trials.append(ModulationTrial(
+                    self.columns["start_idx"][idx], self.columns["end_idx"][idx], self.columns["event_idx"][idx],
+                    self.columns["event_time"][idx], label, self.columns["motion_direction"][idx],
+                    self.columns["block_idx"][idx], events
+                ))
+            self._trials = np.empty((len(trials),), dtype=object)
+            self._trials[:] = trials
         return self._trials
 
+    def cache_arrays(self):
+        # Contents to hash for a PrecalculationCache key
+        return self.columns
+
     def get_trials_attribute(self, attribute_name):
-        # Get a list of attributes by name from the trials
-        data = []
-        for tr in self._trials:
-            data.append(getattr(tr, attribute_name))
-        return np.array(data)
+        # Get an arr of attributes by name from the trials
+        return self.column(attribute_name)
 
 
 class ModulationTrial(object):
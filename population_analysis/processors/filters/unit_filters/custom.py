@@ -1,10 +1,12 @@
 import numpy as np
 
 from population_analysis.processors.filters.unit_filters import UnitFilter
+from population_analysis.processors.kilosort.packed import PackedSpikeTrials
+from population_analysis.processors.kilosort.sparse import SparseSpikeTrains
 
 
 class CustomUnitFilter(UnitFilter):
-    def __init__(self, spike_count_threshold, trial_threshold, missing_threshold, min_missing, baseline_mean_zscore, baseline_time_std_zscore, trial_spike_flags, units, probe_trial_idxs, num_units):
+    def __init__(self, spike_count_threshold, trial_threshold, missing_threshold, min_missing, baseline_mean_zscore, baseline_time_std_zscore, trial_spike_flags, units, probe_trial_idxs, num_units, trial_spike_windows=None):
         self.spike_count_threshold = spike_count_threshold
         self.trial_threshold = trial_threshold
         self.missing_threshold = missing_threshold
@@ -13,7 +15,8 @@ class CustomUnitFilter(UnitFilter):
         self.baseline_time_std_zscore = baseline_time_std_zscore
         # passing_func(unit_num) -> bool
 
-        self.trial_spike_flags = trial_spike_flags
+        self.trial_spike_flags = trial_spike_flags  # (units, trials, 700) arr, PackedSpikeTrials or a SparseSpikeTrains
+        self.trial_spike_windows = trial_spike_windows  # (trials, 2) [start, stop] ms idxs, needed if using SparseSpikeTrains
         self.units = units
         self.probe_trial_idxs = probe_trial_idxs
         self.num_units = num_units
@@ -22,6 +25,18 @@ class CustomUnitFilter(UnitFilter):
 
         super().__init__(passing_func, num_units)
 
+    def _probe_trial_spike_sums(self, unit_num):
+        # Number of spikes in each probe trial for the given unit (trials,)
+        if isinstance(self.trial_spike_flags, SparseSpikeTrains):
+            windows = self.trial_spike_windows[self.probe_trial_idxs]
+            return self.trial_spike_flags.window_counts(unit_num, windows[:, 0], windows[:, 1])
+        if isinstance(self.trial_spike_flags, PackedSpikeTrials):
+            return self.trial_spike_flags.spike_counts(unit_num, self.probe_trial_idxs)
+
+        bool_counts = self.trial_spike_flags  # units x trials x 700
+        unit_trials = bool_counts[unit_num, :, :][self.probe_trial_idxs, :]  # trials x 700
+        return np.sum(unit_trials, axis=1)
+
     def get_passing_func(self):
         def activity_threshold_unit_filter(unit_num):
             """
@@ -52,12 +67,9 @@ class CustomUnitFilter(UnitFilter):
             # standard deviation of the baseline's trial-averaged standard deviations across units
             # baseline_time_std_std = np.std(_baseline_time_stds)
 
-            bool_counts = self.trial_spike_flags  # units x trials x 700
-
-            unit_trials = bool_counts[unit_num, :, :][self.probe_trial_idxs, :]  # trials x 700
             trial_count = len(self.probe_trial_idxs)
 
-            trial_spike_sum = np.sum(unit_trials, axis=1)
+            trial_spike_sum = self._probe_trial_spike_sums(unit_num)
             passing_trial_count = len(np.where(trial_spike_sum >= self.spike_count_threshold)[0])
             missing_trial_count = len(np.where(trial_spike_sum < self.min_missing)[0])
 
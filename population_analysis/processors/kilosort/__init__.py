@@ -1,19 +1,105 @@
 import math
 import os.path
+import shutil
+import tempfile
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
+from population_analysis.consts import PYRAMID_BIN_SIZES_MS, DEFAULT_PRECISION
+from population_analysis.processors.cache import PrecalculationCache, CacheEntry
+from population_analysis.processors.kilosort.parallel import spike_bin_idxs, firingrate_worker, spike_trains_worker
+from population_analysis.processors.kilosort.psth import PeriEventHistogram
+from population_analysis.processors.kilosort.pyramid import FiringRatePyramid
+from population_analysis.processors.kilosort.smoothing import SMOOTHING_KERNELS, smooth_firingrates
+from population_analysis.processors.kilosort.sparse import SparseSpikeTrains
+from population_analysis.processors.precision import precision_dtypes, cast_counts
+
 
 class KilosortProcessor(object):
     FIRING_RATE_PRECALCULATE_FILENAME = "kilosort_firingrates.npy"
-    SPIKES_PRECALCULATE_FILENAME = "kilosort_spikes.npy"
+    SPIKES_PRECALCULATE_FILENAME = "kilosort_spike_trains.npy"
+    SMOOTHED_PRECALCULATE_FILENAME = "kilosort_firingrates_{}_{}ms.npy"  # Formatted with the kernel name and width
+    PYRAMID_PRECALCULATE_FILENAME = "kilosort_pyramid_{}ms.npy"  # Formatted with the bin size of each level
 
-    def __init__(self, spike_clusters, spike_timings):
+    def __init__(self, spike_clusters, spike_timings, chunk_size=None, num_workers=None, cache: PrecalculationCache = None, precision=DEFAULT_PRECISION):
+        # chunk_size is the number of spikes to read at a time, set it to stream spike_clusters and spike_timings
+        # (eg h5py datasets) in chunks instead of reading them into memory all at once
+        # num_workers is the number of processes to split the units across, None to process in this process
+        # cache is where to store precalculated files, None for the current directory (filenames include a hash of the spikes and params)
+        # precision is a key of consts.PRECISIONS, the dtypes to store the spike counts and firing rates as
         self.spike_clusters = spike_clusters
-        self.unique_units = np.unique(self.spike_clusters)
-        self.num_units = len(self.unique_units)
         self.spike_timings = spike_timings
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers
+        self.cache = cache
+        self._spikes_digest = None
+        self.precision = precision
+        self.count_dtype, self.rate_dtype = precision_dtypes(precision)
+
+        if self.chunk_size is None:
+            # spike_unit_idxs is the index into unique_units of each spike, so unique_units[spike_unit_idxs] == spike_clusters
+            self.unique_units, self.spike_unit_idxs = np.unique(self.spike_clusters, return_inverse=True)
+            self.spike_start_time = np.min(self.spike_timings)
+            self.spike_end_time = np.max(self.spike_timings)
+        else:
+            self.spike_unit_idxs = None
+            self._stream_summary()
+
+        self.num_units = len(self.unique_units)
+
+    def _cache_entry(self, stage_name, params) -> CacheEntry:
+        # Spikes are only hashed once per processor, each stage is keyed by that hash and its params
+        if self._spikes_digest is None:
+            print("Hashing spikes for the precalculation cache..")
+            self._spikes_digest = PrecalculationCache.hash_inputs("spikes", [self.spike_clusters, self.spike_timings])
+        return PrecalculationCache.entry_for(self.cache, stage_name, lambda: [self._spikes_digest], params)
+
+    def _firingrates_params(self, bin_size_ms):
+        return {"bin_size_ms": bin_size_ms, "precision": self.precision}
+
+    def _smoothed_params(self, bin_size_ms, kernel_name, kernel_width_ms):
+        return {"bin_size_ms": bin_size_ms, "kernel_name": kernel_name, "kernel_width_ms": kernel_width_ms, "precision": self.precision}
+
+    def firingrates_cache_key(self, bin_size_ms, kernel_name=None, kernel_width_ms=None):
+        # Cache key of calculate_firingrates, or calculate_smoothed_firingrates when given a kernel, so later stages
+        # can be keyed on which rates they used without hashing the rates themselves
+        if kernel_name is None:
+            return self._cache_entry("kilosort_firingrates", self._firingrates_params(bin_size_ms)).key
+        return self._cache_entry("kilosort_smoothed_firingrates", self._smoothed_params(bin_size_ms, kernel_name, kernel_width_ms)).key
+
+    def spikes_cache_key(self):
+        # Cache key of calculate_spikes, see firingrates_cache_key
+        return self._cache_entry("kilosort_spike_trains", {}).key
+
+    def _stream_summary(self):
+        # Find the units and recording start/end with a single streaming pass over the spikes
+        unique_units = np.array([], dtype=self.spike_clusters.dtype)
+        spike_start_time = np.inf
+        spike_end_time = -np.inf
+
+        for start in range(0, len(self.spike_timings), self.chunk_size):
+            unique_units = np.union1d(unique_units, np.asarray(self.spike_clusters[start:start + self.chunk_size]))
+            timings = np.asarray(self.spike_timings[start:start + self.chunk_size])
+            spike_start_time = min(spike_start_time, np.min(timings))
+            spike_end_time = max(spike_end_time, np.max(timings))
+
+        self.unique_units = unique_units
+        self.spike_start_time = spike_start_time
+        self.spike_end_time = spike_end_time
+
+    def _iter_chunks(self):
+        # Yields (spike_unit_idxs, spike_timings) for each chunk of spikes, a single chunk when not streaming
+        if self.chunk_size is None:
+            yield self.spike_unit_idxs, self.spike_timings
+            return
+
+        print(f"Streaming {len(self.spike_timings)} spikes in chunks of {self.chunk_size}..")
+        for start in range(0, len(self.spike_timings), self.chunk_size):
+            clusters = np.asarray(self.spike_clusters[start:start + self.chunk_size])
+            timings = np.asarray(self.spike_timings[start:start + self.chunk_size])
+            yield np.searchsorted(self.unique_units, clusters), timings
 
     def _unit_firingrate(self, unit_num, bins, bin_size_ms):
         # Calculate the firingrate for unit 'unit_num' into the given bins
@@ -24,39 +110,205 @@ class KilosortProcessor(object):
         hist /= bin_size_ms  # Divide by bin size in ms since sampling rate is 1ms
         return hist
 
+    def _spike_bin_idxs(self, bins, spike_timings):
+        # Index of the bin each spike falls into, using the same edges as np.histogram, returns (bin_idxs, in_range)
+        return spike_bin_idxs(bins, spike_timings)
+
+    def _unit_sorted_timings(self, filename):
+        # Counting sort the spike timings by unit into a memmapped file, one chunk at a time
+        # returns the offsets (units + 1,) where unit u's timings are at [offsets[u], offsets[u + 1])
+        unit_counts = np.zeros((self.num_units,), dtype="int64")
+        for unit_idxs, _ in self._iter_chunks():
+            unit_counts += np.bincount(unit_idxs, minlength=self.num_units)
+        unit_offsets = np.zeros((self.num_units + 1,), dtype="int64")
+        unit_offsets[1:] = np.cumsum(unit_counts)
+
+        sorted_timings = np.lib.format.open_memmap(filename, mode="w+", dtype="float64", shape=(unit_offsets[-1],))
+        cursors = unit_offsets[:-1].copy()  # Next free position for each unit
+        for unit_idxs, timings in self._iter_chunks():
+            order = np.argsort(unit_idxs, kind="stable")
+            sorted_units = unit_idxs[order]
+            chunk_counts = np.bincount(unit_idxs, minlength=self.num_units)
+            chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+            positions = cursors[sorted_units] + np.arange(len(order)) - chunk_starts[sorted_units]
+            sorted_timings[positions] = timings[order]
+            cursors += chunk_counts
+
+        sorted_timings.flush()
+        del sorted_timings
+        return unit_offsets
+
+    def _run_unit_workers(self, worker_func, *args):
+        # Split the units into contiguous ranges and run worker_func(*args[:2], unit_start, unit_end, *args[2:]) on each
+        unit_splits = np.linspace(0, self.num_units, min(self.num_workers, self.num_units) + 1).astype("int64")
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = []
+            for unit_start, unit_end in zip(unit_splits[:-1], unit_splits[1:]):
+                futures.append(executor.submit(worker_func, *args[:2], int(unit_start), int(unit_end), *args[2:]))
+            for future in futures:
+                future.result()  # Raise any errors from the workers
+
+    def _parallel_firingrates(self, time_bins, bin_size_ms, out_filename):
+        # Bin the units across num_workers processes, writing straight into the (units, bins) .npy file out_filename
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sorted_timings_filename = os.path.join(tmp_dir, "sorted_timings.npy")
+            bins_filename = os.path.join(tmp_dir, "bins.npy")
+            unit_offsets = self._unit_sorted_timings(sorted_timings_filename)
+            np.save(bins_filename, time_bins)
+
+            print(f"Binning units across {self.num_workers} workers..")
+            self._run_unit_workers(firingrate_worker, sorted_timings_filename, unit_offsets, bins_filename, bin_size_ms, out_filename)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _parallel_spike_trains(self, spike_bins) -> SparseSpikeTrains:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sorted_timings_filename = os.path.join(tmp_dir, "sorted_timings.npy")
+            bins_filename = os.path.join(tmp_dir, "bins.npy")
+            scratch_filename = os.path.join(tmp_dir, "scratch.npy")
+            counts_filename = os.path.join(tmp_dir, "counts.npy")
+
+            unit_offsets = self._unit_sorted_timings(sorted_timings_filename)
+            np.save(bins_filename, spike_bins)
+            np.lib.format.open_memmap(scratch_filename, mode="w+", dtype="int64", shape=(unit_offsets[-1],)).flush()
+            np.lib.format.open_memmap(counts_filename, mode="w+", dtype="int64", shape=(self.num_units,)).flush()
+
+            print(f"Calculating unit spikes across {self.num_workers} workers..")
+            self._run_unit_workers(spike_trains_worker, sorted_timings_filename, unit_offsets, bins_filename, scratch_filename, counts_filename)
+
+            # Compact each unit's spike idxs from the scratch file
+            scratch = np.load(scratch_filename, mmap_mode='r')
+            unit_counts = np.load(counts_filename)
+            offsets = np.zeros((self.num_units + 1,), dtype="int64")
+            offsets[1:] = np.cumsum(unit_counts)
+            spike_idxs = np.empty((offsets[-1],), dtype="int64")
+            for unit_idx in range(self.num_units):
+                spike_idxs[offsets[unit_idx]:offsets[unit_idx + 1]] = scratch[unit_offsets[unit_idx]:unit_offsets[unit_idx] + unit_counts[unit_idx]]
+            scratch._mmap.close()
+            del scratch
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return SparseSpikeTrains(offsets, spike_idxs, len(spike_bins) - 1)
+
+    def _binned_counts(self, bins, out=None):
+        # Calculate the spike counts of every unit into the given bins in a single pass over the spikes
+        # same result as np.histogram(unit_spike_times, bins) for each unit, returns (units, len(bins) - 1)
+        # counts are added onto out if given, so it should start zeroed
+        num_bins = len(bins) - 1
+        if out is None:
+            out = np.zeros((self.num_units, num_bins), dtype="int64")
+
+        for unit_idxs, timings in self._iter_chunks():
+            bin_idxs, in_range = self._spike_bin_idxs(bins, timings)
+            unit_idxs = unit_idxs[in_range]
+            bin_idxs = bin_idxs[in_range]
+            if len(bin_idxs) == 0:
+                continue
+
+            # Only count into the range of bins this chunk covers, which is small when the spikes are sorted by time
+            first_bin = np.min(bin_idxs)
+            chunk_bins = np.max(bin_idxs) - first_bin + 1
+            flat_idxs = unit_idxs * chunk_bins + (bin_idxs - first_bin)  # Index into the flattened (units, chunk_bins) arr
+            counts = np.bincount(flat_idxs, minlength=self.num_units * chunk_bins)
+            out[:, first_bin:first_bin + chunk_bins] += cast_counts(counts.reshape((self.num_units, chunk_bins)), out.dtype)
+
+        return out
+
     def calculate_firingrates(self, bin_size_ms, load_precalculated):
         # bin_size is in ms
         if bin_size_ms < 1:
             warnings.warn("Bin size cannot be < 1! Setting bin_size to 1ms")
             bin_size_ms = 1
         bin_size_seconds = bin_size_ms / 1000
-        spike_start_time = np.min(self.spike_timings)
-        spike_end_time = np.max(self.spike_timings)
+        spike_start_time = self.spike_start_time
+        spike_end_time = self.spike_end_time
 
         time_bins = np.arange(spike_start_time, spike_end_time, bin_size_seconds)
         if time_bins[-1] != spike_end_time:
             time_bins = np.append(time_bins, spike_end_time)  # Add end time if we don't cut exactly
 
+        entry = self._cache_entry("kilosort_firingrates", self._firingrates_params(bin_size_ms))
+        filename = entry.path(KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME)
         if load_precalculated:
-            print("Attempting to load a precalculated firing rate from local directory..")
-            if os.path.exists(KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME):
-                return np.load(KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME, mmap_mode='r'), time_bins
+            print("Attempting to load a precalculated firing rate..")
+            if entry.exists(KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME):
+                return np.load(filename, mmap_mode='r'), time_bins
             else:
-                print(f"Precalculated file '{KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME}' does not exist, generating..")
+                print(f"Precalculated file '{filename}' does not exist, generating..")
 
         print(f"Calculating firingrate of {len(self.unique_units)} Units and {len(self.spike_timings)} spikes, using a bin size of {bin_size_ms} ms")
-        firing_rates = np.empty((self.num_units, len(time_bins) - 1))  # Subtract one to account for end bin edge
-        for idx, unit_num in enumerate(self.unique_units):
-            print(f"Processing Firingrate of Unit {idx}/{self.num_units}")
-            firing_rates[idx, :] = self._unit_firingrate(unit_num, time_bins, bin_size_ms)
-
-        print(f"Finished, writing to file '{KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME}'..")
-        np.save(KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME, firing_rates)
-        del firing_rates
+        # Count straight into the memmapped output file, so only the current chunk of spikes is held in memory
+        firing_rates = np.lib.format.open_memmap(filename, mode="w+", dtype=self.rate_dtype, shape=(self.num_units, len(time_bins) - 1))
+        if self.num_workers is None:
+            firing_rates[:] = 0
+            self._binned_counts(time_bins, out=firing_rates)
+            firing_rates /= bin_size_ms  # Divide by bin size in ms since sampling rate is 1ms
+            print(f"Finished, writing to file '{filename}'..")
+            firing_rates.flush()
+            del firing_rates
+        else:
+            del firing_rates  # Workers open the file and fill in their own units
+            self._parallel_firingrates(time_bins, bin_size_ms, filename)
+        entry.complete()
 
-        fr = np.load(KilosortProcessor.FIRING_RATE_PRECALCULATE_FILENAME, mmap_mode='r')
+        fr = np.load(filename, mmap_mode='r')
         return fr, time_bins
 
+    def calculate_smoothed_firingrates(self, bin_size_ms, kernel_name, kernel_width_ms, load_precalculated):
+        # Kernel smoothed version of calculate_firingrates, on the same bins
+        # kernel_name is a key of SMOOTHING_KERNELS, 'gaussian' (kernel_width_ms is sigma) or 'exponential' (causal, is tau)
+        if kernel_name not in SMOOTHING_KERNELS:
+            raise ValueError(f"Unknown smoothing kernel '{kernel_name}'! Choices are {list(SMOOTHING_KERNELS.keys())}")
+        firing_rates, time_bins = self.calculate_firingrates(bin_size_ms, load_precalculated)
+
+        entry = self._cache_entry("kilosort_smoothed_firingrates", self._smoothed_params(bin_size_ms, kernel_name, kernel_width_ms))
+        basename = KilosortProcessor.SMOOTHED_PRECALCULATE_FILENAME.format(kernel_name, kernel_width_ms)
+        filename = entry.path(basename)
+        if load_precalculated:
+            print("Attempting to load a precalculated smoothed firing rate..")
+            if entry.exists(basename):
+                return np.load(filename, mmap_mode='r'), time_bins
+            else:
+                print(f"Precalculated file '{filename}' does not exist, generating..")
+
+        print(f"Smoothing firing rates of {self.num_units} Units with a {kernel_width_ms}ms {kernel_name} kernel..")
+        kernel, center_idx = SMOOTHING_KERNELS[kernel_name](kernel_width_ms, bin_size_ms)
+        smoothed = np.lib.format.open_memmap(filename, mode="w+", dtype=self.rate_dtype, shape=firing_rates.shape)
+        smooth_firingrates(firing_rates, kernel, center_idx, smoothed)
+
+        print(f"Finished, writing to file '{filename}'..")
+        smoothed.flush()
+        del smoothed
+        entry.complete()
+
+        return np.load(filename, mmap_mode='r'), time_bins
+
+    def calculate_event_firingrates(self, event_times, pre_ms, post_ms, bin_size_ms):
+        # Firing rates (units, events, bins) in the window [event - pre_ms, event + post_ms) around each event time,
+        # binned straight from the spikes without building the whole recording's firing rates. Not cached since the
+        # cost only depends on the number of events
+        psth = PeriEventHistogram(event_times, pre_ms, post_ms, bin_size_ms)
+        print(f"Calculating firing rates of {self.num_units} Units around {psth.num_events} events, {psth.num_bins} bins of {bin_size_ms}ms each..")
+        rates = np.empty((self.num_units, psth.num_events, psth.num_bins), dtype=self.rate_dtype)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sorted_timings_filename = os.path.join(tmp_dir, "sorted_timings.npy")
+            unit_offsets = self._unit_sorted_timings(sorted_timings_filename)
+            sorted_timings = np.load(sorted_timings_filename, mmap_mode='r')
+            for unit_idx in range(self.num_units):
+                unit_timings = np.sort(sorted_timings[unit_offsets[unit_idx]:unit_offsets[unit_idx + 1]])
+                rates[unit_idx] = psth.unit_rates(unit_timings)
+            sorted_timings._mmap.close()
+            del sorted_timings
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return rates
+
     def _round_float(self, flt):
         base = int(math.floor(flt))
         deciml = flt - base
@@ -65,41 +317,90 @@ class KilosortProcessor(object):
         else:
             return int(flt)
 
-    def calculate_spikes(self, load_precalculated):
-        spike_start_time = np.min(self.spike_timings)
-        spike_end_time = np.max(self.spike_timings)
+    def _spike_bins(self):
+        spike_start_time = self.spike_start_time
+        spike_end_time = self.spike_end_time
         spike_bins = np.arange(spike_start_time, spike_end_time, 0.001)
         if spike_bins[-1] != spike_end_time:
             spike_bins = np.append(spike_bins, spike_end_time)  # Add end time if we don't cut exactly
+        return spike_bins
 
+    def spike_trains(self) -> SparseSpikeTrains:
+        # Calculate the 1ms spike flags of all units as a SparseSpikeTrains, without caching
+        spike_bins = self._spike_bins()
         max_spikes = spike_bins.shape[0] - 1  # Number of ms in entire recording, minus one for the bin offset
+        if self.num_workers is not None:
+            return self._parallel_spike_trains(spike_bins)
 
+        def spike_ms_chunks():
+            for unit_idxs, timings in self._iter_chunks():
+                bin_idxs, in_range = self._spike_bin_idxs(spike_bins, timings)
+                if not np.all(in_range):
+                    raise ValueError("Error calculating spike timings! Missing data!")
+                yield unit_idxs, bin_idxs
+
+        return SparseSpikeTrains.from_spike_chunks(spike_ms_chunks(), self.num_units, max_spikes)
+
+    def calculate_spikes(self, load_precalculated) -> SparseSpikeTrains:
+        entry = self._cache_entry("kilosort_spike_trains", {})
+        filename = entry.path(KilosortProcessor.SPIKES_PRECALCULATE_FILENAME)
         if load_precalculated:
-            print("Attempting to load a precalculated spikes from local directory..")
-            if os.path.exists(KilosortProcessor.SPIKES_PRECALCULATE_FILENAME):
-                return np.load(KilosortProcessor.SPIKES_PRECALCULATE_FILENAME, mmap_mode='r')
+            print("Attempting to load a precalculated spikes..")
+            if entry.exists(KilosortProcessor.SPIKES_PRECALCULATE_FILENAME):
+                return SparseSpikeTrains.load(filename)
             else:
-                print(f"Precalculated file '{KilosortProcessor.SPIKES_PRECALCULATE_FILENAME}' does not exist, generating..")
+                print(f"Precalculated file '{filename}' does not exist, generating..")
 
-        spikes = np.full((self.num_units, max_spikes), -1, dtype="int")  # Use -1 to double check after processing, that we didn't miss any spikes
+        print(f"Calculating spikes of {self.num_units} Units and {len(self.spike_timings)} spikes")
+        spikes = self.spike_trains()
 
-        for idx, unit_num in enumerate(self.unique_units):
-            print(f"Calculating spikes for unit {idx}/{self.num_units}")
-            unit_spikes = self._unit_firingrate(unit_num, spike_bins, 1)
-            unit_non_spikes = unit_spikes == 0
-            unit_spike_idxs = np.where(np.logical_not(unit_non_spikes))[0]
-            unit_nonspike_idxs = np.where(unit_non_spikes)[0]
+        print(f"Finished, writing to file '{filename}'..")
+        spikes.save(filename)
+        del spikes
+        entry.complete()
 
-            spikes[idx][unit_spike_idxs] = 1
-            spikes[idx][unit_nonspike_idxs] = 0
+        return SparseSpikeTrains.load(filename)
 
-            total = len(np.where(spikes[idx] == 1)[0]) + len(np.where(spikes[idx] == 0)[0])
-            if total != max_spikes:
-                raise ValueError("Error calculating spike timings! Missing data!")
+    def calculate_firingrate_pyramid(self, load_precalculated, bin_sizes_ms=None) -> FiringRatePyramid:
+        # Count spikes once on the 1ms grid at the finest needed resolution (gcd of the bin sizes), then sum those
+        # counts into each coarser bin size, so any level can be used without going back to the spikes
+        if bin_sizes_ms is None:
+            bin_sizes_ms = PYRAMID_BIN_SIZES_MS
+        spike_bins = self._spike_bins()
+        bin_sizes_ms = sorted(set(int(b) for b in bin_sizes_ms))
+        base_bin_ms = math.gcd(*bin_sizes_ms)
+        level_bins = {b: FiringRatePyramid.level_edges(spike_bins, b) for b in bin_sizes_ms}
+        entry = self._cache_entry("kilosort_pyramid", {"bin_sizes_ms": bin_sizes_ms, "precision": self.precision})
+        basenames = {b: KilosortProcessor.PYRAMID_PRECALCULATE_FILENAME.format(b) for b in bin_sizes_ms}
+        filenames = {b: entry.path(fn) for b, fn in basenames.items()}
 
-        print(f"Finished, writing to file '{KilosortProcessor.SPIKES_PRECALCULATE_FILENAME}'..")
-        np.save(KilosortProcessor.SPIKES_PRECALCULATE_FILENAME, spikes)
-        del spikes
-        sp = np.load(KilosortProcessor.SPIKES_PRECALCULATE_FILENAME, mmap_mode='r')
+        if load_precalculated:
+            print("Attempting to load a precalculated firing rate pyramid..")
+            if entry.exists(*basenames.values()):
+                return FiringRatePyramid({b: np.load(fn, mmap_mode='r') for b, fn in filenames.items()}, level_bins)
+            else:
+                print(f"Precalculated pyramid files {list(filenames.values())} do not all exist, generating..")
+
+        print(f"Calculating {base_bin_ms}ms spike counts of {self.num_units} Units for a firing rate pyramid of {bin_sizes_ms} ms")
+        base_bins = FiringRatePyramid.level_edges(spike_bins, base_bin_ms)
+        base_filename = entry.path(KilosortProcessor.PYRAMID_PRECALCULATE_FILENAME.format(base_bin_ms))
+        base_counts = np.lib.format.open_memmap(base_filename, mode="w+", dtype=self.count_dtype, shape=(self.num_units, len(base_bins) - 1))
+        base_counts[:] = 0
+        self._binned_counts(base_bins, out=base_counts)
+        base_counts.flush()
+
+        for bin_size_ms in bin_sizes_ms:
+            if bin_size_ms == base_bin_ms:
+                continue
+            print(f"Summing {base_bin_ms}ms counts into {bin_size_ms}ms bins..")
+            level = np.lib.format.open_memmap(filenames[bin_size_ms], mode="w+", dtype=self.count_dtype, shape=(self.num_units, len(level_bins[bin_size_ms]) - 1))
+            FiringRatePyramid.downsample(base_counts, bin_size_ms // base_bin_ms, level)
+            level.flush()
+            del level
+
+        del base_counts
+        if base_bin_ms not in bin_sizes_ms:
+            os.remove(base_filename)  # Only needed to build the requested levels
+        entry.complete()
 
-        return sp
+        return FiringRatePyramid({b: np.load(fn, mmap_mode='r') for b, fn in filenames.items()}, level_bins)
@@ -0,0 +1,72 @@
+import numpy as np
+
+# Number of set bits in each possible byte value, for counting spikes without unpacking
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype="uint8")
+
+
+class PackedSpikeTrials(object):
+    # Bit-packed (units, trials, t) 0/1 spike flags, packed with np.packbits along the time axis so each
+    # flag takes a single bit. Indexing unpacks only the selected units/trials, eg packed[unit_num, trial_idxs]
+    def __init__(self, packed, num_timepoints):
+        self.packed = packed  # (units, trials, ceil(t / 8)) uint8
+        self.num_timepoints = int(num_timepoints)
+        assert self.packed.shape[-1] == int(np.ceil(self.num_timepoints / 8))
+
+    @staticmethod
+    def from_dense(spike_flags):
+        # spike_flags is a (units, trials, t) arr of 0/1
+        return PackedSpikeTrials(np.packbits(np.asarray(spike_flags) != 0, axis=-1), spike_flags.shape[-1])
+
+    @staticmethod
+    def load(filename, num_timepoints):
+        return PackedSpikeTrials(np.load(filename, mmap_mode='r'), num_timepoints)
+
+    def save(self, filename):
+        np.save(filename, self.packed)
+
+    def close(self):
+        if isinstance(self.packed, np.memmap):
+            self.packed._mmap.close()
+
+    @property
+    def shape(self):
+        # Shape of the equivalent unpacked array
+        return self.packed.shape[0], self.packed.shape[1], self.num_timepoints
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+    def __getitem__(self, key):
+        # Index into the (units, trials) axes of the packed data, then unpack what is left along time
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError(f"Too many indices for PackedSpikeTrials of shape {self.shape}")
+
+        # Apply each (unit, trial) index separately so list indexes act like chained numpy indexing
+        packed = self.packed
+        if len(key) > 0:
+            packed = packed[key[0]]
+        if len(key) > 1:
+            if np.ndim(packed) == 3:
+                packed = packed[:, key[1]]
+            else:
+                packed = packed[key[1]]
+
+        unpacked = np.unpackbits(packed, axis=-1, count=self.num_timepoints)
+        if len(key) > 2:
+            unpacked = unpacked[..., key[2]]
+        return unpacked
+
+    def unpack(self):
+        # Full dense (units, trials, t) uint8 array
+        return np.unpackbits(self.packed, axis=-1, count=self.num_timepoints)
+
+    def spike_counts(self, unit_idxs=slice(None), trial_idxs=slice(None)):
+        # Number of spikes in each selected unit's trial, counted directly from the packed bytes
+        packed = self.packed[unit_idxs]
+        if np.ndim(packed) == 3:
+            packed = packed[:, trial_idxs]
+        else:
+            packed = packed[trial_idxs]
+        return POPCOUNT_TABLE[packed].sum(axis=-1, dtype="int64")
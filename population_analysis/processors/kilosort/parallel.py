@@ -0,0 +1,53 @@
+import numpy as np
+
+# Worker functions for KilosortProcessor's parallel mode, these are run in separate processes so everything is passed
+# as filenames of .npy files which are opened as memmaps, results are written straight into the output files
+
+
+def spike_bin_idxs(bins, spike_timings):
+    # Index of the bin each spike falls into, using the same edges as np.histogram, returns (bin_idxs, in_range)
+    num_bins = len(bins) - 1
+    bin_idxs = np.searchsorted(bins, spike_timings, side="right") - 1
+    bin_idxs[spike_timings == bins[-1]] = num_bins - 1  # Last bin includes the end edge, like np.histogram
+
+    in_range = np.logical_and(bin_idxs >= 0, bin_idxs < num_bins)
+    return bin_idxs, in_range
+
+
+def firingrate_worker(sorted_timings_filename, unit_offsets, unit_start, unit_end, bins_filename, bin_size_ms, out_filename):
+    # Bin units [unit_start, unit_end) into rows of the (units, bins) output file
+    sorted_timings = np.load(sorted_timings_filename, mmap_mode='r')
+    bins = np.load(bins_filename, mmap_mode='r')
+    out = np.load(out_filename, mmap_mode='r+')
+    num_bins = len(bins) - 1
+
+    for unit_idx in range(unit_start, unit_end):
+        unit_timings = sorted_timings[unit_offsets[unit_idx]:unit_offsets[unit_idx + 1]]
+        bin_idxs, in_range = spike_bin_idxs(bins, unit_timings)
+        counts = np.bincount(bin_idxs[in_range], minlength=num_bins).astype("float64")
+        counts /= bin_size_ms  # Divide by bin size in ms since sampling rate is 1ms
+        out[unit_idx] = counts
+
+    out.flush()
+
+
+def spike_trains_worker(sorted_timings_filename, unit_offsets, unit_start, unit_end, bins_filename, scratch_filename, counts_filename):
+    # Find the unique spike ms idxs of units [unit_start, unit_end), each unit's idxs are written into the scratch file
+    # starting at its unit offset (the number of spikes is an upper bound of the number of spiking ms)
+    sorted_timings = np.load(sorted_timings_filename, mmap_mode='r')
+    bins = np.load(bins_filename, mmap_mode='r')
+    scratch = np.load(scratch_filename, mmap_mode='r+')
+    unit_counts = np.load(counts_filename, mmap_mode='r+')
+
+    for unit_idx in range(unit_start, unit_end):
+        unit_timings = sorted_timings[unit_offsets[unit_idx]:unit_offsets[unit_idx + 1]]
+        bin_idxs, in_range = spike_bin_idxs(bins, unit_timings)
+        if not np.all(in_range):
+            raise ValueError("Error calculating spike timings! Missing data!")
+
+        unit_spikes = np.unique(bin_idxs)
+        scratch[unit_offsets[unit_idx]:unit_offsets[unit_idx] + len(unit_spikes)] = unit_spikes
+        unit_counts[unit_idx] = len(unit_spikes)
+
+    scratch.flush()
+    unit_counts.flush()
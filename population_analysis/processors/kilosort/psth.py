@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class PeriEventHistogram(object):
+    # Spike counts in fixed bins around each event, only looking at the spikes near the events so the cost scales with
+    # the number of events instead of the length of the recording. Bins are [start, end) relative to each event time
+    def __init__(self, event_times, pre_ms, post_ms, bin_size_ms):
+        # event_times (events,) in seconds, the window is [event - pre_ms, event + post_ms)
+        if bin_size_ms <= 0:
+            raise ValueError(f"Bin size must be positive! Got {bin_size_ms}ms")
+        if (pre_ms + post_ms) <= 0 or (pre_ms + post_ms) % bin_size_ms != 0:
+            raise ValueError(f"Window of -{pre_ms}ms to +{post_ms}ms can't be split into {bin_size_ms}ms bins!")
+
+        self.event_times = np.asarray(event_times, dtype="float64")
+        self.pre_ms = pre_ms
+        self.post_ms = post_ms
+        self.bin_size_ms = bin_size_ms
+        self.num_bins = int((pre_ms + post_ms) // bin_size_ms)
+
+        bin_offsets = np.arange(-pre_ms, post_ms + bin_size_ms, bin_size_ms)[:self.num_bins + 1] / 1000  # In seconds
+        self.edges = self.event_times[:, None] + bin_offsets[None, :]  # (events, bins + 1)
+
+    @property
+    def num_events(self):
+        return len(self.event_times)
+
+    @property
+    def bin_centers_ms(self):
+        # Center of each bin relative to the event, in ms
+        return np.arange(self.num_bins) * self.bin_size_ms - self.pre_ms + self.bin_size_ms / 2
+
+    def unit_counts(self, sorted_unit_timings):
+        # (events, bins) spike counts of one unit, sorted_unit_timings are the unit's spike times in ascending order
+        # a single searchsorted of every edge into the spikes, the count in a bin is the difference of its edges
+        edge_idxs = np.searchsorted(sorted_unit_timings, self.edges.ravel(), side="left").reshape(self.edges.shape)
+        return np.diff(edge_idxs, axis=1)
+
+    def unit_rates(self, sorted_unit_timings):
+        # (events, bins) firing rates in spikes per ms, like KilosortProcessor.calculate_firingrates
+        rates = self.unit_counts(sorted_unit_timings).astype("float64")
+        rates /= self.bin_size_ms
+        return rates
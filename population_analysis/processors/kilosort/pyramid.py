@@ -0,0 +1,58 @@
+import numpy as np
+
+from population_analysis.processors.precision import cast_counts
+
+
+class FiringRatePyramid(object):
+    # Spike counts of all units at several bin sizes, every level's bin edges are taken from the same 1ms grid as the
+    # spike trains, so each coarser level is exactly the sum of the finest level's bins
+    def __init__(self, level_counts, level_bins):
+        self.level_counts = level_counts  # {bin_size_ms: (units, bins) spike counts}
+        self.level_bins = level_bins  # {bin_size_ms: (bins + 1,) bin edges in seconds}
+
+    @staticmethod
+    def level_edges(ms_bins, bin_size_ms):
+        # Bin edges for bin_size_ms, from the 1ms bin edges ms_bins, the last bin is partial if it doesn't cut exactly
+        edges = ms_bins[::bin_size_ms]
+        if edges[-1] != ms_bins[-1]:
+            edges = np.append(edges, ms_bins[-1])
+        return edges
+
+    @staticmethod
+    def downsample(counts, factor, out, unit_chunk_size=16):
+        # Sum every 'factor' bins of (units, bins) counts into out, a few units at a time
+        num_full = counts.shape[1] // factor
+        for unit_start in range(0, counts.shape[0], unit_chunk_size):
+            unit_counts = np.asarray(counts[unit_start:unit_start + unit_chunk_size])
+            summed = unit_counts[:, :num_full * factor].reshape((unit_counts.shape[0], num_full, factor)).sum(axis=2)
+            out[unit_start:unit_start + unit_chunk_size, :num_full] = cast_counts(summed, out.dtype)
+            if out.shape[1] > num_full:
+                out[unit_start:unit_start + unit_chunk_size, num_full] = cast_counts(unit_counts[:, num_full * factor:].sum(axis=1), out.dtype)  # Partial last bin
+        return out
+
+    @property
+    def bin_sizes(self):
+        return sorted(self.level_counts.keys())
+
+    def _check_level(self, bin_size_ms):
+        if bin_size_ms not in self.level_counts:
+            raise ValueError(f"No pyramid level for a bin size of {bin_size_ms}ms! Levels are {self.bin_sizes}")
+
+    def counts(self, bin_size_ms):
+        self._check_level(bin_size_ms)
+        return self.level_counts[bin_size_ms]
+
+    def bins(self, bin_size_ms):
+        self._check_level(bin_size_ms)
+        return self.level_bins[bin_size_ms]
+
+    def rates(self, bin_size_ms, unit_idxs=slice(None)):
+        # Firing rates (units, bins) in spikes per ms, like KilosortProcessor.calculate_firingrates
+        rates = np.asarray(self.counts(bin_size_ms)[unit_idxs]).astype("float64")
+        rates /= bin_size_ms
+        return rates
+
+    def close(self):
+        for counts in self.level_counts.values():
+            if isinstance(counts, np.memmap):
+                counts._mmap.close()
@@ -0,0 +1,37 @@
+import math
+
+import numpy as np
+from scipy.signal import oaconvolve
+
+
+def gaussian_kernel(sigma_ms, bin_size_ms):
+    # Symmetric gaussian out to 4 sigma, returns (kernel, center_idx) where center_idx is the kernel's time 0
+    half_len = int(math.ceil(4 * sigma_ms / bin_size_ms))
+    times = np.arange(-half_len, half_len + 1) * bin_size_ms
+    kernel = np.exp(-(times ** 2) / (2 * sigma_ms ** 2))
+    return kernel / np.sum(kernel), half_len
+
+
+def causal_exponential_kernel(tau_ms, bin_size_ms):
+    # Exponential decay out to 5 tau, only uses the current and past bins so a response can't lead its spikes
+    kernel_len = int(math.ceil(5 * tau_ms / bin_size_ms)) + 1
+    times = np.arange(kernel_len) * bin_size_ms
+    kernel = np.exp(-times / tau_ms)
+    return kernel / np.sum(kernel), 0
+
+
+SMOOTHING_KERNELS = {
+    "gaussian": gaussian_kernel,
+    "exponential": causal_exponential_kernel
+}
+
+
+def smooth_firingrates(firing_rates, kernel, center_idx, out, unit_chunk_size=16):
+    # Convolve every unit's (units, t) firing rate with the kernel along time, using batched overlap-add FFT
+    # convolution on a few units at a time, writing the (units, t) result into out
+    num_timepoints = firing_rates.shape[1]
+    for unit_start in range(0, firing_rates.shape[0], unit_chunk_size):
+        unit_rates = np.asarray(firing_rates[unit_start:unit_start + unit_chunk_size], dtype="float64")  # Convolve in full precision
+        convolved = oaconvolve(unit_rates, kernel[None, :], mode="full", axes=1)
+        out[unit_start:unit_start + unit_chunk_size] = convolved[:, center_idx:center_idx + num_timepoints]
+    return out
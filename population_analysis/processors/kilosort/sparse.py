@@ -0,0 +1,151 @@
+import numpy as np
+
+
+class SparseSpikeTrains(object):
+    # Compact CSR-style store of millisecond spike flags, equivalent to a dense (units, ms) array of 0/1 where
+    # unit u spiked at the ms indexes spike_idxs[offsets[u]:offsets[u + 1]] (sorted, no duplicates)
+    #
+    # Saved as a single int64 .npy so it can be memmapped, laid out like
+    # [num_units, num_ms, offsets (num_units + 1,), spike_idxs (total,)]
+    HEADER_LEN = 2
+
+    def __init__(self, offsets, spike_idxs, num_ms, mmap_array=None):
+        self.offsets = offsets  # (units + 1,)
+        self.spike_idxs = spike_idxs  # (total spike ms,)
+        self.num_ms = int(num_ms)
+        self.num_units = len(offsets) - 1
+        self._mmap_array = mmap_array  # Backing memmap when loaded from a file
+
+    @staticmethod
+    def from_spikes(spike_unit_idxs, spike_ms_idxs, num_units, num_ms):
+        # spike_unit_idxs is the unit index (0 to num_units-1) of each spike, spike_ms_idxs is the ms bin of each spike
+        # multiple spikes of the same unit in the same ms are collapsed into a single flag
+        return SparseSpikeTrains.from_spike_chunks([(spike_unit_idxs, spike_ms_idxs)], num_units, num_ms)
+
+    @staticmethod
+    def from_spike_chunks(chunks, num_units, num_ms):
+        # Same as from_spikes, but consumes an iterable of (spike_unit_idxs, spike_ms_idxs) chunks one at a time
+        unit_spikes = [[] for _ in range(num_units)]
+        for spike_unit_idxs, spike_ms_idxs in chunks:
+            flat = np.unique(spike_unit_idxs.astype("int64") * num_ms + spike_ms_idxs)  # Sorts by unit then ms, removes dupes
+            chunk_units = flat // num_ms
+            unit_bounds = np.searchsorted(chunk_units, np.arange(num_units + 1))
+            for unit_idx in np.unique(chunk_units):
+                unit_spikes[unit_idx].append(flat[unit_bounds[unit_idx]:unit_bounds[unit_idx + 1]] - unit_idx * num_ms)
+
+        offsets = np.zeros((num_units + 1,), dtype="int64")
+        for unit_idx in range(num_units):
+            chunk_spikes = unit_spikes[unit_idx]
+            if len(chunk_spikes) == 0:
+                unit_spikes[unit_idx] = np.array([], dtype="int64")
+            elif len(chunk_spikes) == 1:
+                unit_spikes[unit_idx] = chunk_spikes[0]
+            else:
+                unit_spikes[unit_idx] = np.unique(np.concatenate(chunk_spikes))  # Chunks can share a ms at their edges
+            offsets[unit_idx + 1] = offsets[unit_idx] + len(unit_spikes[unit_idx])
+
+        return SparseSpikeTrains(offsets, np.concatenate(unit_spikes), num_ms)
+
+    @staticmethod
+    def load(filename):
+        arr = np.load(filename, mmap_mode='r')
+        num_units, num_ms = int(arr[0]), int(arr[1])
+        offsets_end = SparseSpikeTrains.HEADER_LEN + num_units + 1
+        return SparseSpikeTrains(arr[SparseSpikeTrains.HEADER_LEN:offsets_end], arr[offsets_end:], num_ms, mmap_array=arr)
+
+    def save(self, filename):
+        arr = np.lib.format.open_memmap(filename, mode="w+", dtype="int64", shape=(SparseSpikeTrains.HEADER_LEN + len(self.offsets) + len(self.spike_idxs),))
+        arr[0] = self.num_units
+        arr[1] = self.num_ms
+        offsets_end = SparseSpikeTrains.HEADER_LEN + len(self.offsets)
+        arr[SparseSpikeTrains.HEADER_LEN:offsets_end] = self.offsets
+        arr[offsets_end:] = self.spike_idxs
+        arr.flush()
+        del arr
+
+    def close(self):
+        if self._mmap_array is not None:
+            self._mmap_array._mmap.close()
+            self._mmap_array = None
+
+    def cache_arrays(self):
+        # Contents to hash for a PrecalculationCache key
+        return [self.num_ms, self.offsets, self.spike_idxs]
+
+    @property
+    def shape(self):
+        # Shape of the equivalent dense array
+        return self.num_units, self.num_ms
+
+    def unit_spike_idxs(self, unit_idx):
+        return self.spike_idxs[self.offsets[unit_idx]:self.offsets[unit_idx + 1]]
+
+    def window_counts(self, unit_idx, starts, ends):
+        # Number of spiking ms for unit_idx in each [start, end) window, without materializing the windows
+        unit_spikes = self.unit_spike_idxs(unit_idx)
+        return np.searchsorted(unit_spikes, ends) - np.searchsorted(unit_spikes, starts)
+
+    def window(self, unit_idx, start, end):
+        # Dense (end - start,) spike flags for a single unit
+        return self.trial_windows(np.array([start]), end - start, unit_idxs=[unit_idx])[0, 0]
+
+    def to_dense(self, start=0, end=None):
+        # Dense (units, end - start) spike flags, only use on small ranges!
+        end = self.num_ms if end is None else end
+        return self.trial_windows(np.array([start]), end - start)[:, 0]
+
+    def _window_spikes(self, unit_idx, starts, window_len):
+        # (trial_idxs, ms_offsets) of every spike of unit_idx in the windows [start, start + window_len), gathering
+        # all windows at once by expanding each window's [lo, hi) range of spikes into flat indexes
+        unit_spikes = self.unit_spike_idxs(unit_idx)
+        lo = np.searchsorted(unit_spikes, starts)
+        counts = np.searchsorted(unit_spikes, starts + window_len) - lo
+
+        trial_idxs = np.repeat(np.arange(len(starts)), counts)
+        spike_pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        return trial_idxs, unit_spikes[spike_pos] - starts[trial_idxs]
+
+    def summed_windows(self, starts, window_len, unit_idxs=None):
+        # (units, window_len) number of the windows [start, start + window_len) with a spike at each ms into the window,
+        # like trial_windows(..).sum(axis=1) without materializing the windows
+        starts = np.asarray(starts, dtype="int64")
+        unit_idxs = range(self.num_units) if unit_idxs is None else unit_idxs
+        out = np.zeros((len(unit_idxs), window_len), dtype="int64")
+
+        for idx, unit_idx in enumerate(unit_idxs):
+            _, ms_offsets = self._window_spikes(unit_idx, starts, window_len)
+            out[idx] = np.bincount(ms_offsets, minlength=window_len)
+
+        return out
+
+    def packed_trial_windows(self, starts, window_len, unit_idxs=None, out=None):
+        # Bit-packed (units, len(starts), ceil(window_len / 8)) spike flags of the windows [start, start + window_len),
+        # packed like np.packbits along time (see PackedSpikeTrials) straight from the spikes, without the dense windows
+        starts = np.asarray(starts, dtype="int64")
+        unit_idxs = range(self.num_units) if unit_idxs is None else unit_idxs
+        num_bytes = int(np.ceil(window_len / 8))
+        if out is None:
+            out = np.zeros((len(unit_idxs), len(starts), num_bytes), dtype="uint8")
+
+        for idx, unit_idx in enumerate(unit_idxs):
+            trial_idxs, ms_offsets = self._window_spikes(unit_idx, starts, window_len)
+            # Each spike ms is a distinct bit, so summing the bit values of a byte is the same as or-ing them
+            byte_idxs = trial_idxs * num_bytes + ms_offsets // 8
+            bit_values = np.left_shift(1, 7 - ms_offsets % 8)  # packbits puts the first ms in the highest bit
+            out[idx] = np.bincount(byte_idxs, weights=bit_values, minlength=len(starts) * num_bytes).reshape((len(starts), num_bytes))
+
+        return out
+
+    def trial_windows(self, starts, window_len, unit_idxs=None, out=None):
+        # Materialize dense (units, len(starts), window_len) spike flags, for windows [start, start + window_len)
+        starts = np.asarray(starts, dtype="int64")
+        unit_idxs = range(self.num_units) if unit_idxs is None else unit_idxs
+        if out is None:
+            out = np.zeros((len(unit_idxs), len(starts), window_len), dtype="int")
+
+        for idx, unit_idx in enumerate(unit_idxs):
+            out[idx] = 0
+            trial_idxs, ms_offsets = self._window_spikes(unit_idx, starts, window_len)
+            out[idx, trial_idxs, ms_offsets] = 1
+
+        return out
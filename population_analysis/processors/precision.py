@@ -0,0 +1,19 @@
+import numpy as np
+
+from population_analysis.consts import PRECISIONS
+
+
+def precision_dtypes(precision):
+    # Returns the (counts_dtype, rates_dtype) of a precision name, see consts.PRECISIONS
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}'! Choices are {list(PRECISIONS.keys())}")
+    dtypes = PRECISIONS[precision]
+    return np.dtype(dtypes["counts"]), np.dtype(dtypes["rates"])
+
+
+def cast_counts(counts, dtype):
+    # Cast spike counts to a (possibly narrower) integer dtype, erroring instead of silently overflowing
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer) and counts.size > 0 and np.max(counts) > np.iinfo(dtype).max:
+        raise ValueError(f"Spike count of {np.max(counts)} doesn't fit in {dtype}! Use a wider precision")
+    return counts.astype(dtype, copy=False)
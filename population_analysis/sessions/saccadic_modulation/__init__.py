@@ -13,7 +13,12 @@ from population_analysis.processors.filters.unit_filters import UnitFilter
 from population_analysis.processors.filters.unit_filters import CustomUnitFilter
 from population_analysis.processors.filters.unit_filters import QualityMetricsUnitFilter
 from population_analysis.processors.filters.unit_filters import ZetaUnitFilter
+from population_analysis.processors.experiments.saccadic_modulation.events import EventIndex
 from population_analysis.processors.experiments.saccadic_modulation.rp_peri_calculator import RpPeriCalculator
+from population_analysis.processors.kilosort import KilosortProcessor
+from population_analysis.processors.kilosort.packed import PackedSpikeTrials
+from population_analysis.processors.kilosort.pyramid import FiringRatePyramid
+from population_analysis.processors.kilosort.sparse import SparseSpikeTrains
 
 
 class NWBSession(object):
@@ -49,6 +54,9 @@ class NWBSession(object):
         self.num_trials = self.nwb.processing["behavior"]["trial_motion_directions"].data[:].shape[0]
         self.num_units = self.nwb.processing["behavior"]["unit_labels"].data[:].shape[0]
         self._tmp_rpp_recalc = None
+        self._spike_trains = None
+        self._pyramid = None
+        self._event_index = None
         tw = 2
         print("done")
 
@@ -69,8 +77,99 @@ class NWBSession(object):
             metrics[metric_name] = nwb.processing["behavior"][f"metric-{metric_name}"].data[:]
         return metrics
 
-    def spikes(self):
-        return self.nwb.processing["behavior"]["trial_spike_times"].data[:]  # (units, trials, 700)
+    def _read_unit_trials(self, name, unit_idxs=None, trial_idxs=None):
+        # Reads a (units, trials, ..) dataset, only reading the units and the range of trials that are selected
+        # so a chunked dataset only decompresses the chunks that are needed. idxs can be ints or bool masks
+        data = self.nwb.processing["behavior"][name].data
+        if unit_idxs is None and trial_idxs is None:
+            return data[:]
+
+        if unit_idxs is not None:
+            unit_idxs = np.asarray(unit_idxs)
+            unit_idxs = np.where(unit_idxs)[0] if unit_idxs.dtype == bool else unit_idxs.astype(int) % data.shape[0]
+        if trial_idxs is not None:
+            trial_idxs = np.asarray(trial_idxs)
+            trial_idxs = np.where(trial_idxs)[0] if trial_idxs.dtype == bool else trial_idxs.astype(int) % data.shape[1]
+
+        num_units = data.shape[0] if unit_idxs is None else len(unit_idxs)
+        num_trials = data.shape[1] if trial_idxs is None else len(trial_idxs)
+        if num_units == 0 or num_trials == 0:
+            return np.empty((num_units, num_trials, *data.shape[2:]), dtype=data.dtype)
+
+        unit_sel = slice(None)
+        unit_remap = None
+        if unit_idxs is not None:
+            # h5py needs increasing unique idxs, read those and remap them to the requested order
+            unique_units, unit_remap = np.unique(unit_idxs, return_inverse=True)
+            if unique_units[-1] - unique_units[0] + 1 == len(unique_units):
+                unit_sel = slice(unique_units[0], unique_units[-1] + 1)
+            else:
+                unit_sel = unique_units
+
+        trial_sel = slice(None)
+        trial_remap = None
+        if trial_idxs is not None:
+            trial_start = np.min(trial_idxs)
+            trial_sel = slice(trial_start, np.max(trial_idxs) + 1)
+            trial_remap = trial_idxs - trial_start
+
+        read = data[unit_sel, trial_sel]
+        if unit_remap is not None:
+            read = read[unit_remap]
+        if trial_remap is not None:
+            read = read[:, trial_remap]
+        return read
+
+    def spikes(self, unit_idxs=None, trial_idxs=None):
+        # unit_idxs and trial_idxs only read those units/trials, see _read_unit_trials
+        spikes = self._read_unit_trials("trial_spike_times", unit_idxs, trial_idxs)
+        if spikes.dtype == np.uint8:
+            # Bit-packed along time, unpacks to (units, trials, 700) when indexed
+            durations = self.trial_durations()
+            return PackedSpikeTrials(spikes, durations[0][1] - durations[0][0])
+        return spikes  # (units, trials, 700) in older unpacked files
+
+    def spike_trains(self) -> SparseSpikeTrains:
+        # Sparse 1ms spike flags of the whole recording (units, ms), index with trial_durations()
+        if self._spike_trains is None:
+            spike_clusters = self.nwb.processing["behavior"]["spike_clusters"].data[:]
+            spike_timestamps = self.nwb.processing["behavior"]["spike_timestamps"].data[:]
+            self._spike_trains = KilosortProcessor(spike_clusters, spike_timestamps).spike_trains()
+        return self._spike_trains
+
+    def firingrate_pyramid(self) -> FiringRatePyramid:
+        # Spike counts of the whole recording at each of consts.PYRAMID_BIN_SIZES_MS, precalculated in the current directory
+        if self._pyramid is None:
+            spike_clusters = self.nwb.processing["behavior"]["spike_clusters"].data[:]
+            spike_timestamps = self.nwb.processing["behavior"]["spike_timestamps"].data[:]
+            self._pyramid = KilosortProcessor(spike_clusters, spike_timestamps).calculate_firingrate_pyramid(True)
+        return self._pyramid
+
+    def trial_firing_rates(self, bin_size_ms, unit_idxs=None, trial_idxs=None):
+        # (units, trials, t) firing rates in spikes per ms of each trial's window binned at bin_size_ms, one of the
+        # firingrate_pyramid() levels, rather than interpolating the SPIKE_BIN_MS units(). Not normalized
+        durations = self.trial_durations()  # ms idxs, so idxs into the pyramid's 1ms grid
+        trial_len_ms = int(durations[0][1] - durations[0][0])
+        if trial_idxs is not None:
+            durations = durations[trial_idxs]
+        trial_starts = durations[:, 0].astype(int)
+        if trial_len_ms % bin_size_ms != 0 or np.any(trial_starts % bin_size_ms != 0):
+            raise ValueError(f"Trial windows don't line up with {bin_size_ms}ms bins!")
+
+        counts = self.firingrate_pyramid().counts(bin_size_ms)
+        if unit_idxs is not None:
+            counts = counts[np.asarray(unit_idxs)]
+        bin_idxs = (trial_starts // bin_size_ms)[:, None] + np.arange(trial_len_ms // bin_size_ms)[None, :]  # (trials, t)
+        return np.asarray(counts[:, bin_idxs], dtype="float64") / bin_size_ms
+
+    def event_index(self) -> EventIndex:
+        # Index of the probe and saccade timestamps, for queries like the saccades within a window of each probe
+        if self._event_index is None:
+            self._event_index = EventIndex({
+                "probe": self.nwb.processing["behavior"]["probes"].data[:],
+                "saccade": self.nwb.processing["behavior"]["saccades"].data[:]
+            })
+        return self._event_index
 
     def trial_motion_directions(self):
         return self.nwb.processing["behavior"]["trial_motion_directions"].data[:]
@@ -82,26 +181,27 @@ class NWBSession(object):
         return self.nwb.processing["behavior"]["trial_spike_duration_idxs"].data[:]  # (trials, 2)  [start, stop]
 
     def probe_units(self):
-        return self.units()[:, self.probe_trial_idxs]
+        return self.units(trial_idxs=self.probe_trial_idxs)
 
     def saccade_units(self):
-        return self.units()[:, self.saccade_trial_idxs]
+        return self.units(trial_idxs=self.saccade_trial_idxs)
 
     def mixed_units(self):
-        return self.units()[:, self.mixed_trial_idxs]
-
-    def rp_peri_units(self):
+        return self.units(trial_idxs=self.mixed_trial_idxs)
 
+    def rp_peri_units(self, unit_idxs=None, trial_idxs=None):
+        # unit_idxs and trial_idxs only read those units/trials, see _read_unit_trials
         if self.use_normalized_units:
-            return self.nwb.processing["behavior"]["normalized_trial_rp_peri_response_firing_rates"].data[:]
+            return self._read_unit_trials("normalized_trial_rp_peri_response_firing_rates", unit_idxs, trial_idxs)
         else:
-            return self.nwb.processing["behavior"]["trial_rp_peri_response_firing_rates"].data[:]
+            return self._read_unit_trials("trial_rp_peri_response_firing_rates", unit_idxs, trial_idxs)
 
-    def units(self):
+    def units(self, unit_idxs=None, trial_idxs=None):
+        # unit_idxs and trial_idxs only read those units/trials, see _read_unit_trials
         if self.use_normalized_units:
-            return self.nwb.processing["behavior"]["normalized_trial_response_firing_rates"].data[:]
+            return self._read_unit_trials("normalized_trial_response_firing_rates", unit_idxs, trial_idxs)
         else:
-            return self.nwb.processing["behavior"]["trial_response_firing_rates"].data[:]  # units x trials x t
+            return self._read_unit_trials("trial_response_firing_rates", unit_idxs, trial_idxs)  # units x trials x t
 
     def unit_filter_premade(self) -> UnitFilter:
         print("Initializing premade unit filter..")
@@ -115,7 +215,15 @@ class NWBSession(object):
     def unit_filter_probe_zeta(self) -> UnitFilter:
         return ZetaUnitFilter(self.nwb.processing["behavior"]["probe_zeta_scores"].data[:])
 
-    def unit_filter_custom(self, spike_count_threshold, trial_threshold, missing_threshold, min_missing, baseline_mean_zscore, baseline_time_std_zscore) -> UnitFilter:
+    def unit_filter_custom(self, spike_count_threshold, trial_threshold, missing_threshold, min_missing, baseline_mean_zscore, baseline_time_std_zscore, use_spike_trains=False) -> UnitFilter:
+        # use_spike_trains will count spikes from the sparse spike_trains() instead of loading the dense trial spikes
+        if use_spike_trains:
+            spike_flags = self.spike_trains()
+            spike_windows = self.trial_durations()
+        else:
+            spike_flags = self.spikes()
+            spike_windows = None
+
         return CustomUnitFilter(
             spike_count_threshold,
             trial_threshold,
@@ -123,10 +231,11 @@ class NWBSession(object):
             min_missing,
             baseline_mean_zscore,
             baseline_time_std_zscore,
-            self.nwb.processing["behavior"]["trial_spike_times"].data[:],
+            spike_flags,
             self.units(),
             self.probe_trial_idxs,
-            self.num_units
+            self.num_units,
+            trial_spike_windows=spike_windows
         )
 
     def trial_motion_filter(self, motion_direction) -> TrialFilter:
@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+
+from population_analysis.consts import SPIKE_BIN_MS
+from population_analysis.processors.kilosort import KilosortProcessor
+
+
+def generate_spikes(num_units, recording_seconds, mean_rate_hz):
+    # Random poisson-ish spikes, (spike_clusters, spike_timings) sorted by time like kilosort output
+    num_spikes = int(num_units * recording_seconds * mean_rate_hz)
+    spike_clusters = np.random.randint(0, num_units, size=num_spikes)
+    spike_timings = np.sort(np.random.uniform(0, recording_seconds, size=num_spikes))
+    return spike_clusters, spike_timings
+
+
+def loop_firingrates(kp, time_bins, bin_size_ms):
+    # Previous per-unit implementation, one full scan of the spikes for each unit
+    firing_rates = np.empty((kp.num_units, len(time_bins) - 1))
+    for idx, unit_num in enumerate(kp.unique_units):
+        firing_rates[idx, :] = kp._unit_firingrate(unit_num, time_bins, bin_size_ms)
+    return firing_rates
+
+
+def main():
+    np.random.seed(0)
+    bin_size_ms = SPIKE_BIN_MS
+
+    for num_units, recording_seconds in [(50, 600), (200, 1200), (500, 1800)]:
+        spike_clusters, spike_timings = generate_spikes(num_units, recording_seconds, 5)
+        kp = KilosortProcessor(spike_clusters, spike_timings)
+
+        time_bins = np.arange(np.min(spike_timings), np.max(spike_timings), bin_size_ms / 1000)
+        time_bins = np.append(time_bins, np.max(spike_timings))
+
+        start = time.perf_counter()
+        looped = loop_firingrates(kp, time_bins, bin_size_ms)
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectorized = kp._binned_counts(time_bins) / bin_size_ms
+        vec_time = time.perf_counter() - start
+
+        assert np.array_equal(looped, vectorized)
+        print(f"{num_units} units, {len(spike_timings)} spikes, {len(time_bins) - 1} bins: "
+              f"loop {loop_time:.3f}s, single pass {vec_time:.3f}s, speedup {loop_time / vec_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
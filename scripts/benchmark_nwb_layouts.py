@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pendulum
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+
+from population_analysis.consts import NUM_FIRINGRATE_SAMPLES
+from population_analysis.processors.experiments.saccadic_modulation.hdf import HDFSessionProcessor
+
+# (name, compression, trial_chunk_size) layouts to compare, see HDFSessionProcessor.nwb_dataset
+LAYOUTS = [
+    ("plain", None, None),
+    ("lzf-256", "lzf", 256),
+    ("gzip-64", "gzip", 64),
+    ("gzip-256", "gzip", 256),
+    ("gzip-1024", "gzip", 1024),
+    ("gzip-unit", "gzip", None)
+]
+NUM_READS = 20
+
+
+def generate_rates(num_units, num_trials):
+    # Poisson-ish binned firing rates like the trial response firing rates, (units, trials, t) in spikes per ms
+    unit_rates = np.random.uniform(0.001, 0.05, size=(num_units, 1, 1))
+    counts = np.random.poisson(unit_rates * 20, size=(num_units, num_trials, NUM_FIRINGRATE_SAMPLES))
+    return counts / 20
+
+
+def write_nwb(filename, rates, compression, trial_chunk_size):
+    nwb = NWBFile(session_description="benchmark", identifier="benchmark", session_start_time=pendulum.now().subtract(years=1))
+    behavior = nwb.create_processing_module(name="behavior", description="benchmark")
+    data = HDFSessionProcessor.nwb_dataset(rates, compression, trial_chunk_size)
+    behavior.add(TimeSeries(name="trial_response_firing_rates", data=data, rate=1.0, unit="spikes", description="benchmark"))
+    with NWBHDF5IO(filename, "w") as io:
+        io.write(nwb)
+
+
+def time_reads(dataset, read_func):
+    # Mean seconds per read, each read with new random idxs
+    total = 0
+    for _ in range(NUM_READS):
+        start = time.perf_counter()
+        read_func(dataset)
+        total += time.perf_counter() - start
+    return total / NUM_READS
+
+
+def main():
+    np.random.seed(0)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for num_units, num_trials in [(100, 2000), (300, 5000)]:
+            rates = generate_rates(num_units, num_trials)
+            print(f"{num_units} units, {num_trials} trials, {rates.nbytes / 1024 ** 2:.1f}MB of firing rates")
+
+            def trial_block(ds):
+                block_start = np.random.randint(num_trials - 256)
+                return ds[:, block_start:block_start + 256]
+
+            # Access patterns of the analysis, a single unit, a few units then a subset of their trials, a trial block
+            reads = [
+                ("one unit", lambda ds: ds[np.random.randint(num_units)]),
+                ("10 units, 1/4 trials", lambda ds: ds[np.sort(np.random.choice(num_units, 10, replace=False))][:, ::4]),
+                ("trial block", trial_block),
+                ("everything", lambda ds: ds[:])
+            ]
+
+            for layout_name, compression, trial_chunk_size in LAYOUTS:
+                filename = os.path.join(tmp_dir, f"{layout_name}.nwb")
+                start = time.perf_counter()
+                write_nwb(filename, rates, compression, trial_chunk_size)
+                write_time = time.perf_counter() - start
+
+                with NWBHDF5IO(filename, "r") as io:
+                    dataset = io.read().processing["behavior"]["trial_response_firing_rates"].data
+                    read_times = [(read_name, time_reads(dataset, read_func)) for read_name, read_func in reads]
+
+                reads_str = ", ".join([f"{read_name} {read_time * 1000:.2f}ms" for read_name, read_time in read_times])
+                print(f"  {layout_name}: {os.path.getsize(filename) / 1024 ** 2:.1f}MB, write {write_time:.2f}s, {reads_str}")
+                os.remove(filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
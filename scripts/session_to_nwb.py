@@ -3,6 +3,7 @@ import time
 
 import h5py
 
+from population_analysis.consts import NORMALIZER_UNIT_CHUNK_SIZE
 from population_analysis.processors.experiments.saccadic_modulation.hdf import HDFSessionProcessor
 
 
@@ -38,6 +39,14 @@ def main():
 
     data_files = check_for_data(sessions_path)
     force = False
+    stream_chunk_size = 10_000_000  # Number of spikes to read from the raw HDF at a time, None to read them all at once
+    num_workers = None  # Number of processes to split the units across when binning spikes, None to use this process
+    cache_dir = os.path.join(sessions_output_path, "precalculated")  # Shared by all sessions, entries are keyed by their inputs
+    cache_max_bytes = 200 * 1024 ** 3  # Least recently used precalculated files are removed past this size
+    precision = "double"  # 'compact' stores firing rates as float32 and spike counts as uint16, see consts.PRECISIONS
+    normalizer_unit_chunk_size = NORMALIZER_UNIT_CHUNK_SIZE  # Number of units to normalize trial firing rates for at a time, None for all at once
+    rp_peri_alignment = "bin"  # 'ms' aligns the RpPeri saccade template to each trial's saccade using the 1ms spikes
+    nwb_compression = "gzip"  # Compression of the (units, trials, t) NWB datasets, None, 'lzf' (h5py only) or 'gzip'
 
     # dd = dictify_hd5(h5py.File("output.hdf"))
     # data_files = "mlati9-2023-07-14-output.hdf": "E:\\PopulationAnalysisRawHDF\\google_drive\\mlati9-2023-07-14-output.hdf"}
@@ -45,38 +54,27 @@ def main():
     # force = True
 
     # data_files = {"generated.hdf-nwb": "generated.hdf"}
-    olddir = os.getcwd()
-
     while True:
         print("Scanning for files to process..")
         for filename, filepath in data_files.items():
             try:
-                os.chdir(olddir)
                 print(f"Processing '{filename}'")
                 name = ".".join(filename.split(".")[:-1])
                 name = os.path.join(sessions_output_path, name)
                 if not os.path.exists(name):
                     os.mkdir(name)
-                os.chdir(name)
 
-                nwb_filename = f"{filename}.nwb"
+                nwb_filename = os.path.join(name, f"{filename}.nwb")
                 # if os.path.exists(nwb_filename) and not force:
                 #     print("Already processed, skipping..")
                 #     continue
                 mouse_name = filename.split("-")[0]
                 session_id = filename[len(mouse_name) + 1:-len("-output.hdf")]  # Chop off 'mlati8-' and '-output.hdf'
 
-                raw = HDFSessionProcessor(filepath, mouse_name, session_id)
-                raw.save_to_nwb(nwb_filename, load_precalculated=True)
+                raw = HDFSessionProcessor(filepath, mouse_name, session_id, stream_chunk_size=stream_chunk_size, num_workers=num_workers, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, precision=precision, normalizer_unit_chunk_size=normalizer_unit_chunk_size)
+                raw.save_to_nwb(nwb_filename, load_precalculated=True, rp_peri_alignment=rp_peri_alignment, compression=nwb_compression)
                 asdasdafasfasd
                 del raw
-                to_remove = ["calc_firingrates.npy", "calc_norm_firingrates.npy", "calc_rpperi_firingrates.npy", "calc_rpperi_norm_firingrates.npy", "calc_spike_trials.npy", "kilosort_firingrates.npy", "kilosort_spikes.npy", "calc_large_norm_firingrates.npy", "saccadic-trials.pickle"]
-                for fn in to_remove:
-                    print(f"Removing {fn}..")
-                    try:
-                        os.remove(fn)
-                    except Exception as e:
-                        print(f"Couldn't remove '{fn}' Error: '{str(e)}'")
             except Exception as e2:
                 raise e2
                 print(f"Error with file {filename} Skipping, Exception {e2}")